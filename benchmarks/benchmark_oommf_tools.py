@@ -0,0 +1,335 @@
+"""
+Benchmarks of the reading, colouring and plotting functions of oommf_tools,
+using synthetic OMF (text and binary) and ODT files, so OOMMF is not needed
+
+Every stage is timed (best of a number of repeats) and its peak of allocated
+memory is measured with tracemalloc in an extra run. Results are saved in a
+JSON file, which can be compared with the results of another commit:
+
+    python benchmark_oommf_tools.py --output results_new.json
+    python benchmark_oommf_tools.py --sizes 100x100x20 --compare old.json
+
+"""
+import numpy as np
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+import types
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.join(BENCHMARKS_DIR, '..'))
+import oommf_tools as ot
+import initial_states as ist
+
+# Cuboid meshes (nx, ny, nz) from the sizes of the simulations of this repo
+SIZES = {'100x100x20': (100, 100, 20),
+         '200x200x40': (200, 200, 40),
+         '400x400x80': (400, 400, 80),
+         }
+CELL = 5e-9
+MS = 0.648 / (4 * np.pi * 1e-7)
+
+# -----------------------------------------------------------------------------
+# Synthetic data
+
+
+def synthetic_state(nx, ny, nz, seed=42):
+    """
+    Returns a (nz, ny, nx, 3) magnetisation (in A/m) with a type II bubble
+    plus noise, so text files have digits as in OOMMF outputs
+    """
+    geometry = synthetic_geometry(nx, ny, nz)
+    m = ist.type2bubble(geometry, R=0.2 * nx * CELL)
+    m += 0.05 * np.random.RandomState(seed).normal(size=m.shape)
+    ot.normalise(m)
+    return MS * m.transpose(2, 1, 0, 3)
+
+
+def synthetic_geometry(nx, ny, nz):
+    return ot.mesh_geometry((-0.5 * nx * CELL, -0.5 * ny * CELL, 0),
+                            (0.5 * nx * CELL, 0.5 * ny * CELL, nz * CELL),
+                            (CELL, CELL, CELL))
+
+
+def write_synthetic_omf(filename, nx, ny, nz, data_format='binary 8'):
+    ot.write_omf(filename, synthetic_state(nx, ny, nz),
+                 synthetic_geometry(nx, ny, nz),
+                 data_format=data_format,
+                 title='Oxs_MinDriver::Magnetization')
+    return filename
+
+
+# Columns as in the ODT files of the MinDriver simulations
+ODT_COLUMNS = [('Oxs_CGEvolve::Max mxHxm', 'A/m'),
+               ('Oxs_CGEvolve::Total energy', 'J'),
+               ('Oxs_CGEvolve::Delta E', 'J'),
+               ('Oxs_CGEvolve::Bracket count', '{}'),
+               ('Oxs_CGEvolve::Line min count', '{}'),
+               ('Oxs_CGEvolve::Conjugate cycle count', '{}'),
+               ('Oxs_CGEvolve::Cycle count', '{}'),
+               ('Oxs_CGEvolve::Cycle sub count', '{}'),
+               ('Oxs_CGEvolve::Energy calc count', '{}'),
+               ('Oxs_Demag::Energy', 'J'),
+               ('Oxs_UniformExchange::Max Spin Ang', 'deg'),
+               ('Oxs_UniformExchange::Energy', 'J'),
+               ('Oxs_FixedZeeman::Energy', 'J'),
+               ('Oxs_MinDriver::Iteration', '{}'),
+               ('Oxs_MinDriver::Stage iteration', '{}'),
+               ('Oxs_MinDriver::Stage', '{}'),
+               ('Oxs_MinDriver::mx', '{}'),
+               ('Oxs_MinDriver::my', '{}'),
+               ('Oxs_MinDriver::mz', '{}'),
+               ]
+
+
+def write_synthetic_odt(filename, n_rows, seed=42):
+    def tcl(s):
+        return '{' + s + '}' if (' ' in s or not s) else s
+
+    data = np.random.RandomState(seed).uniform(-1, 1,
+                                               (n_rows, len(ODT_COLUMNS)))
+    data[:, 13] = np.arange(n_rows)
+
+    with open(filename, 'w') as f:
+        f.write('# ODT 1.0\n# Table Start\n# Title: Oxs_MinDriver\n')
+        f.write('# Columns: ' +
+                ' '.join(tcl(c) for c, u in ODT_COLUMNS) + '\n')
+        f.write('# Units: ' +
+                ' '.join(tcl(u.strip('{}')) for c, u in ODT_COLUMNS) + '\n')
+        np.savetxt(f, data, fmt='%.17g')
+        f.write('# Table End\n')
+
+    return filename
+
+
+# -----------------------------------------------------------------------------
+# Timing
+
+
+def measure(function, repeat=3):
+    """
+    Returns the best time of repeat calls of function and the peak of memory
+    allocated (in bytes) by one call, traced with tracemalloc. Memory mapped
+    files do not count as allocated memory
+    """
+    times = []
+    for i in range(repeat):
+        t0 = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - t0)
+
+    tracemalloc.start()
+    function()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    return min(times), peak
+
+
+def read_m(omf_path, workers=1):
+    omf_file = ot.OOMMFDataRead(omf_path)
+    omf_file.read_m(workers)
+    return omf_file
+
+
+def compute_magnetisation_stage(nx, ny, nz):
+    """
+    Returns the IsolatedBubble.compute_magnetisation benchmark, which is
+    called on an object with the field array of a discretisedfield Field, or
+    None if joommf_bubble cannot be imported (it requires oommfc)
+    """
+    try:
+        import joommf_bubble
+    except Exception as e:
+        print('joommf_bubble cannot be imported: {}'.format(e))
+        return None
+
+    sim = types.SimpleNamespace(
+        Ms=MS,
+        mesh=types.SimpleNamespace(n=(nx, ny, nz)),
+        system=types.SimpleNamespace(m=types.SimpleNamespace(
+            array=synthetic_state(nx, ny, nz).transpose(2, 1, 0, 3))))
+
+    return lambda: joommf_bubble.IsolatedBubble.compute_magnetisation(sim)
+
+
+def render_stage(omf_path, png_folder, n_frames=3):
+    """
+    Benchmark of the frame loop of plot_states.py: n_frames renders of the
+    centre layer with a single LayerRenderer
+    """
+    import oommf_render as orender
+    omf_file = ot.OOMMFDataRead(omf_path)
+    renderer = orender.LayerRenderer(omf_file, z_index=omf_file.nz // 2,
+                                     arrow_stride=5, figsize=(12, 12),
+                                     dpi=150, quiver_scale=0.05)
+
+    def render():
+        for i in range(n_frames):
+            renderer.render(omf_file,
+                            os.path.join(png_folder, 'frame{}.png'.format(i)))
+
+    return render
+
+
+def run_benchmarks(sizes, folder, repeat=3, odt_rows=20000, render=True):
+    """
+    Runs all the stages for the list of size labels (keys of SIZES), using
+    folder to write the synthetic files. Returns a list of results
+    """
+    results = []
+
+    def add(stage, size, data_format, function, repeats=repeat):
+        if function is None:
+            print('{:<26} {:<12} {:<9} skipped'.format(stage, size,
+                                                      data_format))
+            return
+        try:
+            t, peak = measure(function, repeats)
+        except Exception as e:
+            # A failing stage does not stop the other benchmarks
+            print('{:<26} {:<12} {:<9} failed: {}'.format(stage, size,
+                                                         data_format, e))
+            return
+        results.append({'stage': stage, 'size': size,
+                        'format': data_format,
+                        'time': t, 'peak_memory': peak})
+        print('{:<26} {:<12} {:<9} {:9.4f} s {:9.1f} MB'.format(
+              stage, size, data_format, t, peak / 1e6))
+
+    for size in sizes:
+        nx, ny, nz = SIZES[size]
+
+        omfs = {}
+        for data_format in ['text', 'binary 4', 'binary 8']:
+            omfs[data_format] = write_synthetic_omf(
+                os.path.join(folder, 'm_{}_{}.omf'.format(
+                    size, data_format.replace(' ', ''))),
+                nx, ny, nz, data_format)
+
+        for data_format, omf_path in omfs.items():
+            label = data_format.replace(' ', '')
+            add('read_header', size, label,
+                lambda: ot.OOMMFDataRead(omf_path))
+            add('read_m', size, label, lambda: read_m(omf_path))
+            if data_format == 'text':
+                # Text parsed by all the cores, to compare with the single
+                # process parser of read_m
+                add('read_m_parallel', size, label,
+                    lambda: read_m(omf_path, workers=None))
+            add('read_layer', size, label,
+                lambda: ot.OOMMFDataRead(omf_path).read_layer(nz // 2))
+
+        omf_file = read_m(omfs['binary 8'])
+        add('set_coordinates', size, '-',
+            lambda: (ot.mesh_coordinates.cache_clear(),
+                     omf_file.set_coordinates()))
+        m_flat = omf_file.m.reshape(-1, 3)
+        for model in ['rgb', 'hls', 'rgba']:
+            add('generate_colours_' + model, size, '-',
+                lambda: ot.generate_colours(m_flat, colour_model=model))
+        del omf_file, m_flat
+
+        add('compute_magnetisation', size, '-',
+            compute_magnetisation_stage(nx, ny, nz))
+
+        if render:
+            add('render_frames', size, 'binary8',
+                render_stage(omfs['binary 8'], folder), repeats=1)
+
+        for omf_path in omfs.values():
+            os.remove(omf_path)
+
+    odt_path = write_synthetic_odt(os.path.join(folder, 'table.odt'),
+                                   odt_rows)
+    odt_label = '{}rows'.format(odt_rows)
+    add('OOMMFODTRead', odt_label, 'text',
+        lambda: ot.OOMMFODTRead(odt_path))
+    add('OOMMFODTRead_columns', odt_label, 'text',
+        lambda: ot.OOMMFODTRead(odt_path, columns=['Oxs_MinDriver::mz']))
+    add('OOMMFODTRead_parallel', odt_label, 'text',
+        lambda: ot.OOMMFODTRead(odt_path, workers=None))
+    add('last_odt_row', odt_label, 'text',
+        lambda: ot.last_odt_row(odt_path))
+
+    return results
+
+
+# -----------------------------------------------------------------------------
+# Results
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'], cwd=BENCHMARKS_DIR,
+            stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def save_results(results, output):
+    with open(output, 'w') as f:
+        json.dump({'commit': git_commit(),
+                   'date': time.strftime('%Y-%m-%d %H:%M:%S'),
+                   'python': platform.python_version(),
+                   'numpy': np.__version__,
+                   'machine': platform.machine(),
+                   'cpu_count': os.cpu_count(),
+                   'results': results}, f, indent=1)
+
+
+def compare_results(results, reference_file, threshold=1.2):
+    """
+    Prints the time and memory ratios of the results with respect to the
+    results in reference_file, marking the stages slower than threshold
+    """
+    with open(reference_file) as f:
+        reference = json.load(f)
+    ref = {(r['stage'], r['size'], r['format']): r
+           for r in reference['results']}
+
+    print('\nComparison with {} (commit {})'.format(reference_file,
+                                                   reference.get('commit')))
+    for r in results:
+        key = (r['stage'], r['size'], r['format'])
+        if key not in ref:
+            continue
+        time_ratio = r['time'] / ref[key]['time']
+        memory_ratio = r['peak_memory'] / max(1, ref[key]['peak_memory'])
+        print('{:<26} {:<12} {:<9} time x{:6.2f}  memory x{:6.2f} {}'.format(
+              *key, time_ratio, memory_ratio,
+              '<-- SLOWER' if time_ratio > threshold else ''))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--sizes', default=','.join(SIZES),
+                        help='comma separated mesh sizes, from: {}'.format(
+                             ', '.join(SIZES)))
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--odt-rows', type=int, default=20000)
+    parser.add_argument('--no-render', action='store_true',
+                        help='skip the PNG rendering benchmark')
+    parser.add_argument('--output', default='benchmark_results.json')
+    parser.add_argument('--compare', default=None,
+                        help='JSON results file to compare with')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as folder:
+        results = run_benchmarks(args.sizes.split(','), folder,
+                                 repeat=args.repeat,
+                                 odt_rows=args.odt_rows,
+                                 render=not args.no_render)
+
+    save_results(results, args.output)
+    print('Results saved in', args.output)
+
+    if args.compare is not None:
+        compare_results(results, args.compare)
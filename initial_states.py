@@ -0,0 +1,122 @@
+import numpy as np
+
+import oommf_tools as ot
+
+
+# -----------------------------------------------------------------------------
+# Vectorised initial states
+#
+# Every function takes the mesh geometry tuple (see oommf_tools.mesh_geometry)
+# and returns the magnetisation as a (nx, ny, nz, 3) array, which can be used
+# as the value of a discretisedfield Field or saved as an OMF file with
+# write_initial_state, to be loaded in OOMMF with Oxs_FileVectorField
+
+
+def mesh_axes(geometry):
+    """
+    Returns the X, Y, Z coordinates (in m) of the cell centres as
+    broadcastable arrays with shapes (nx, 1, 1), (1, ny, 1), (1, 1, nz)
+    """
+    nx, ny, nz, dx, dy, dz, xbase, ybase, zbase = geometry
+    return ((xbase + np.arange(nx) * dx)[:, np.newaxis, np.newaxis],
+            (ybase + np.arange(ny) * dy)[np.newaxis, :, np.newaxis],
+            (zbase + np.arange(nz) * dz)[np.newaxis, np.newaxis, :])
+
+
+def uniform(geometry, m=(0, 0, 1)):
+    """
+    Uniform state along m
+    """
+    nx, ny, nz = geometry[:3]
+    field = np.empty((nx, ny, nz, 3))
+    field[...] = m
+    return field
+
+
+def type2bubble(geometry, R=80e-9, centre=(0, 0)):
+    """
+    Type II bubble of radius R: a Bloch-like skyrmion profile across the
+    sample thickness where the in-plane components are reversed for y < 0
+    (see joommf_bubble.init_type2bubble_bls_II and the typeIIbubble script
+    of the MIF files)
+    """
+    X, Y, Z = mesh_axes(geometry)
+    x, y = X - centre[0], Y - centre[1]
+
+    r = np.sqrt(x ** 2 + y ** 2)
+    phi_b = np.arctan2(y, x) + 0.5 * np.pi
+    k = np.pi / R
+
+    # Sign of the in-plane components: zero outside the bubble and at y = 0
+    sign = np.where(r < R, np.sign(y), 0.)
+
+    field = np.empty(geometry[:3] + (3,))
+    field[..., 0] = sign * np.sin(k * r) * np.cos(phi_b)
+    field[..., 1] = sign * np.sin(k * r) * np.sin(phi_b)
+    field[..., 2] = np.where(sign != 0, -np.cos(k * r), 1.)
+
+    return field
+
+
+def bloch_skyrmion(geometry, R=80e-9, centre=(0, 0), helicity=0.5 * np.pi):
+    """
+    Skyrmion of radius R, with m_z = -1 at the centre and a linear profile
+    of the polar angle. helicity = pi / 2 gives a Bloch skyrmion and
+    helicity = 0 a Neel skyrmion
+    """
+    X, Y, Z = mesh_axes(geometry)
+    x, y = X - centre[0], Y - centre[1]
+
+    r = np.sqrt(x ** 2 + y ** 2)
+    theta = np.where(r < R, np.pi * (1 - r / R), 0.)
+    psi = np.arctan2(y, x) + helicity
+
+    field = np.empty(geometry[:3] + (3,))
+    field[..., 0] = np.sin(theta) * np.cos(psi)
+    field[..., 1] = np.sin(theta) * np.sin(psi)
+    field[..., 2] = np.cos(theta)
+
+    return field
+
+
+def hexagonal_bubble_lattice(geometry, R_rel=0.06, x0=0.1, y0=0.08,
+                             spacing=0.2, n_columns=6, n_rows=7):
+    """
+    Hexagonal lattice of dots with m_z = -1 in a m_z = 1 background, as the
+    bubble_lattice script of the MIF files. Positions and radius are
+    relative to the sample size (relpt coordinates in OOMMF)
+    """
+    nx, ny, nz, dx, dy, dz, xbase, ybase, zbase = geometry
+    X, Y, Z = mesh_axes(geometry)
+    xr = (X[:, :, 0] - (xbase - 0.5 * dx)) / (nx * dx)
+    yr = (Y[:, :, 0] - (ybase - 0.5 * dy)) / (ny * dy)
+
+    inside = np.zeros((nx, ny), dtype=bool)
+    for row in range(n_rows):
+        yb = y0 + row * spacing * 0.5 * np.sqrt(3)
+        for column in range(n_columns):
+            xb = x0 + spacing * (column - 0.5 * (row % 2))
+            inside |= (xr - xb) ** 2 + (yr - yb) ** 2 < R_rel ** 2
+
+    field = np.zeros((nx, ny, nz, 3))
+    field[..., 2] = np.where(inside, -1., 1.)[:, :, np.newaxis]
+
+    return field
+
+
+def random_film(geometry, seed=42):
+    """
+    Randomly oriented spins, uniformly distributed on the sphere
+    """
+    random = np.random.RandomState(seed)
+    field = random.normal(size=geometry[:3] + (3,))
+    return ot.normalise(field)
+
+
+def write_initial_state(filename, field, geometry, data_format='binary 8'):
+    """
+    Saves a (nx, ny, nz, 3) initial state as an OMF file, to be used in
+    OOMMF with Oxs_FileVectorField
+    """
+    ot.write_omf(filename, field.transpose(2, 1, 0, 3), geometry,
+                 data_format=data_format, title='Initial state', units='')
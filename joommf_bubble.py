@@ -2,34 +2,44 @@ import oommfc as oc
 import discretisedfield as df
 import numpy as np
 import matplotlib.pyplot as plt
-
-import colorsys
-plt.style.use('styles/lato_style.mplstyle')
+import os
+import time
+import functools
+from concurrent.futures import ProcessPoolExecutor
+
+import oommf_tools as ot
+import oommf_analysis as oa
+import initial_states as ist
+# Style of the notebooks, found from this file so the module can be
+# imported from any folder
+plt.style.use(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                           'notebooks', 'styles', 'lato_style.mplstyle'))
 mu0 = 4 * np.pi * 1e-7
 
 
-def convert_to_RGB(hls_color):
-    return np.array(colorsys.hls_to_rgb(hls_color[0] / (2 * np.pi),
-                                        hls_color[1],
-                                        hls_color[2]))
+def timed(name):
+    """
+    Decorator of IsolatedBubble methods which appends their wall time (in s)
+    to the list self.timings[name]
+    """
+    def decorator(method):
+        @functools.wraps(method)
+        def wrapper(self, *args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return method(self, *args, **kwargs)
+            finally:
+                self.__dict__.setdefault('timings', {}).setdefault(
+                    name, []).append(time.perf_counter() - start)
+        return wrapper
+    return decorator
 
 
 def generate_RGBs(field_data):
     """
     field_data      ::  (n, 3) array
     """
-    hls = np.ones_like(field_data)
-    hls[:, 0] = np.arctan2(field_data[:, 1],
-                           field_data[:, 0]
-                           )
-    hls[:, 0][hls[:, 0] < 0] = hls[:, 0][hls[:, 0] < 0] + 2 * np.pi
-    hls[:, 1] = 0.5 * (field_data[:, 2] + 1)
-    rgbs = np.apply_along_axis(convert_to_RGB, 1, hls)
-
-    # Redefine colours less than zero
-    # rgbs[rgbs < 0] += 2 * np.pi
-
-    return rgbs
+    return ot.generate_colours(field_data, colour_model='rgb')
 
 
 # def init_dot(pos):
@@ -85,12 +95,21 @@ class IsolatedBubble(object):
         thickness           :: cuboid thickness
         init_state_radius   :: initial state radius
         cell                :: discretisation cell lengths
+        name                :: name of the OOMMF system (and of the folder
+                               of its files), which must be unique for
+                               simulations running at the same time
+
+    Wall times of the construction, energy minimisation (and of the OOMMF
+    drive within it), computation of the magnetisation arrays and saving
+    of the data are stored in the timings dictionary, see timing_report
     """
 
+    @timed('construction')
     def __init__(self, A=20e-12, Ms=0.648, B=0.1,
                  L=400e-9, thickness=100e-9,
                  init_state_radius=80e-9,
-                 cell=(4e-9, 4e-9, 4e-9)
+                 cell=(4e-9, 4e-9, 4e-9),
+                 name='oommf_typeII_bubble'
                  ):
         self.A = A
         self.Ms = Ms / mu0
@@ -105,41 +124,37 @@ class IsolatedBubble(object):
               'nm'
               )
 
-        self.mesh = oc.Mesh(p1=(-self.L/2, -self.L/2, -self.thickness/2),
-                            p2=(self.L/2, self.L/2, self.thickness/2),
-                            cell=cell)
+        self.p1 = (-self.L/2, -self.L/2, -self.thickness/2)
+        self.p2 = (self.L/2, self.L/2, self.thickness/2)
+        self.mesh = oc.Mesh(p1=self.p1, p2=self.p2, cell=cell)
+        # Mesh geometry tuple, see oommf_tools. The mesh arrays follow the
+        # order of OOMMF files (x changes fastest and z slowest)
+        self.geometry = ot.mesh_geometry(self.p1, self.p2, cell)
 
-        self.system = oc.System(name='oommf_typeII_bubble')
+        self.system = oc.System(name=name)
         # Add interactions
-        self.system.hamiltonian = (oc.Exchange(A=self.A) +
-                                   oc.UniaxialAnisotropy(K1=self.Ku,
-                                                           u=(0, 0, 1)) +
-                                   oc.Demag() +
-                                   oc.Zeeman((0, 0, self.B / mu0))
-                                   )
+        self.system.hamiltonian = self.hamiltonian()
 
+        # Initial state computed for all the cells at once (same profile
+        # as init_type2bubble_bls_II)
         self.system.m = df.Field(self.mesh,
-                                 value=lambda r: init_type2bubble_bls_II(r, init_state_radius),
+                                 value=ist.type2bubble(self.geometry,
+                                                       R=init_state_radius),
                                  norm=self.Ms)
         # self.system.m = df.Field(self.mesh, value=(0, 0.1, 0.99),
         #                          norm=self.Ms)
 
         self.md = oc.MinDriver()
 
-        # Get system cordinates
-        self.coordinates = np.array(list(self.system.m.mesh.coordinates))
+        nx, ny, nz, dx, dy, dz = self.geometry[:6]
 
-        # Turn coordinates into a (N, 3) array and save in corresponding
-        # variables scaled in nm
-        self.x, self.y, self.z = (self.coordinates[:, 0] * 1e9,
-                                  self.coordinates[:, 1] * 1e9,
-                                  self.coordinates[:, 2] * 1e9
-                                  )
-
-        # Array with uniue z coordinates
-        self.xs = np.unique(self.x)
-        self.ys = np.unique(self.y)
-        self.zs = np.unique(self.z)
+        # Arrays with the unique x, y, z coordinates in nm (axes of the
+        # mesh). Coordinates of the cells are broadcast from them (see
+        # meshgrid), and the flat coordinates array is only generated when
+        # it is requested
+        self.xs = (self.geometry[6] + np.arange(nx) * dx) * 1e9
+        self.ys = (self.geometry[7] + np.arange(ny) * dy) * 1e9
+        self.zs = (self.geometry[8] + np.arange(nz) * dz) * 1e9
 
         self.z_layers = {}
         for i, z in enumerate(self.zs):
@@ -148,12 +163,125 @@ class IsolatedBubble(object):
         # Compute the initial magnetisation profile
         self.compute_magnetisation()
 
-    def minimise_energy(self):
+    def meshgrid(self):
+        """
+        Returns the X, Y, Z coordinates in nm as arrays of shape
+        (nz, ny, nx), matching self.m. These are broadcast views of the
+        axis vectors, thus no memory is allocated for them
+        """
+        shape = (len(self.zs), len(self.ys), len(self.xs))
+        return (np.broadcast_to(self.xs[np.newaxis, np.newaxis, :], shape),
+                np.broadcast_to(self.ys[np.newaxis, :, np.newaxis], shape),
+                np.broadcast_to(self.zs[:, np.newaxis, np.newaxis], shape))
+
+    @property
+    def coordinates(self):
+        """
+        (n, 3) array with the coordinates in m, in the order of mx, my, mz.
+        It is generated the first time it is requested
+        """
+        if getattr(self, '_coordinates', None) is None:
+            self._coordinates = ot.mesh_coordinates(self.geometry) * 1e-9
+        return self._coordinates
+
+    @property
+    def x(self):
+        # Flat coordinates in nm (read-only arrays shared by all the
+        # systems with the same mesh, see oommf_tools.mesh_coordinates)
+        return ot.mesh_coordinates(self.geometry)[:, 0]
+
+    @property
+    def y(self):
+        return ot.mesh_coordinates(self.geometry)[:, 1]
+
+    @property
+    def z(self):
+        return ot.mesh_coordinates(self.geometry)[:, 2]
+
+    def hamiltonian(self):
+        return (oc.Exchange(A=self.A) +
+                oc.UniaxialAnisotropy(K1=self.Ku, u=(0, 0, 1)) +
+                oc.Demag() +
+                oc.Zeeman((0, 0, self.B / mu0))
+                )
+
+    def set_field(self, B):
+        """
+        Changes the applied field (in Tesla) of the Zeeman term of the
+        system. The mesh, the other terms and the current magnetisation are
+        kept, thus the next minimisation starts from the current state
+        """
+        self.B = B
+        self.system.hamiltonian.zeeman.H = (0, 0, self.B / mu0)
+
+    @timed('minimise_energy')
+    def minimise_energy(self, coarse_factors=()):
+        """
+        Relaxes the system with the MinDriver. With coarse_factors, e.g.
+        (4, 2), the system is relaxed first on meshes with cells factor
+        times larger (see relax_coarse), from the coarsest, and the final
+        relaxation starts from the refined state
+        """
+        meshes = []
+        for factor in sorted(coarse_factors, reverse=True):
+            # Factors can give the same mesh when the cells are not
+            # divisible (see oommf_tools.coarse_geometry)
+            geometry = ot.coarse_geometry(self.geometry, factor)
+            if geometry not in meshes:
+                meshes.append(geometry)
+                self.relax_coarse(factor)
+
+        start = time.perf_counter()
         self.md.drive(self.system)
+        self.timings.setdefault('drive', []).append(
+            time.perf_counter() - start)
 
         # Update the agnetisation arrays
         self.compute_magnetisation()
 
+    @timed('relax_coarse')
+    def relax_coarse(self, factor=2):
+        """
+        Relaxes the current state on a mesh with cells factor times larger,
+        where domain walls move with fewer and cheaper iterations, and sets
+        the relaxed state, interpolated to the mesh of the system (see
+        oommf_tools.resample), as the magnetisation of the system.
+        Directions where the number of cells is not a multiple of factor
+        are coarsened less (see oommf_tools.coarse_geometry)
+        """
+        geometry = ot.coarse_geometry(self.geometry, factor)
+        mesh = oc.Mesh(p1=self.p1, p2=self.p2, cell=geometry[3:6])
+
+        system = oc.System(name='{}_coarse{}'.format(self.system.name,
+                                                     factor))
+        system.hamiltonian = self.hamiltonian()
+
+        # Field arrays have shape (nx, ny, nz, 3) and the resampling
+        # functions use the (nz, ny, nx, 3) order of OMF files
+        m = ot.resample(self.system.m.array.transpose(2, 1, 0, 3),
+                        self.geometry, geometry)
+        system.m = df.Field(mesh, value=m.transpose(2, 1, 0, 3),
+                            norm=self.Ms)
+
+        self.md.drive(system)
+
+        m = ot.resample(system.m.array.transpose(2, 1, 0, 3),
+                        geometry, self.geometry)
+        self.system.m = df.Field(self.mesh, value=m.transpose(2, 1, 0, 3),
+                                 norm=self.Ms)
+
+    def timing_report(self):
+        """
+        Prints the total and mean wall times of the timed stages (see the
+        timings dictionary) and returns a dictionary with the totals
+        """
+        totals = {}
+        for name, times in self.timings.items():
+            totals[name] = sum(times)
+            print('{:<24} {:4d} calls  {:10.3f} s  (mean {:.3f} s)'.format(
+                  name, len(times), totals[name], totals[name] / len(times)))
+        return totals
+
     def plot_state(self, size=8, n_arrows=40):
         fig = plt.figure(figsize=(size, size))
         ax = fig.add_subplot(111)
@@ -161,69 +289,243 @@ class IsolatedBubble(object):
         self.system.m.z.imshow("z", ax=ax)
         self.system.m.quiver("z", ax=ax, n=(n_arrows, n_arrows))
 
+    @timed('compute_magnetisation')
     def compute_magnetisation(self):
-        # phi_oommf = np.arctan2(y_oommf, x_oommf)
-        # Get the magnetisation for every coordinate in the magnetisation list
-        values = []
-        for c in self.coordinates:
-            values.append(self.system.m(c))
-        values = np.array(values)
+        """
+        Computes the normalised magnetisation from the field array (with
+        shape (nx, ny, nz, 3)) as the self.m array with shape
+        (nz, ny, nx, 3), and the mx, my, mz arrays in the order of the
+        coordinates, which are views of self.m
+        """
+        values = self.system.m.array
+        nx, ny, nz = self.mesh.n
+
+        # The self.m array is allocated once and the normalised values are
+        # written into it (reading the transposed view of the field values)
+        if getattr(self, 'm', None) is None or self.m.shape[:3] != (nz, ny,
+                                                                    nx):
+            self.m = np.empty((nz, ny, nx, 3))
+        np.divide(values.transpose(2, 1, 0, 3), self.Ms, out=self.m)
 
         # Save them in the corresponding row and column of the m list
         # mx, my, mz:
-        self.mx, self.my, self.mz = (values[:, 0] / self.Ms,
-                                     values[:, 1] / self.Ms,
-                                     values[:, 2] / self.Ms)
+        m_flat = self.m.reshape(-1, 3)
+        self.mx, self.my, self.mz = (m_flat[:, 0],
+                                     m_flat[:, 1],
+                                     m_flat[:, 2])
 
         # mphi = lambda z_i: (-mx_O * np.sin(phi_O) + my_O * np.cos(phi_O))[_filter_y_O(z_i)]
         # mr = lambda z_i: (mx_O * np.cos(phi_O) + my_O * np.sin(phi_O))[_filter_y_O(z_i)]
 
-    def plot_slice(self, n_slice=0, arrow_stride=7):
+    def plot_slice(self, n_slice=0, arrow_stride=7, level='auto',
+                   figsize=(8, 8)):
         """
+        Plots the z-layer n_slice with the HSL colours of the magnetisation
+        and arrows every arrow_stride cells. Large layers are block averaged
+        (see oommf_tools.block_average) to the resolution of the figure:
+        level is the block size or 'auto' to choose it from the figure
+        width in pixels
         """
         print('Plotting for slice at z =', self.zs[n_slice], 'nm')
-        z_filter = self.z == np.unique(self.zs)[n_slice]
-
-        f, ax = plt.subplots(ncols=1, figsize=(8, 8))
-
-        rgb_map = generate_RGBs(np.column_stack((self.mx[z_filter],
-                                                 self.my[z_filter],
-                                                 self.mz[z_filter])))
-        # ax.scatter(self.x[z_filter], self.y[z_filter],
-        #            c=rgb_map, marker='s',
-        #            # s=20
-        #            )
-        xmin, xmax = (np.min(self.x[z_filter]) - 0.5 * self.mesh.cell[0] * 1e9,
-                      np.max(self.x[z_filter]) + 0.5 * self.mesh.cell[0] * 1e9)
-        ymin, ymax = (np.min(self.y[z_filter]) - 0.5 * self.mesh.cell[1] * 1e9,
-                      np.max(self.y[z_filter]) + 0.5 * self.mesh.cell[1] * 1e9)
-        ax.imshow(rgb_map.reshape(self.mesh.n[0], -1, 3),
+
+        f, ax = plt.subplots(ncols=1, figsize=figsize)
+
+        if level == 'auto':
+            level = ot.lod_level(len(self.xs), figsize[0] * f.dpi)
+        m_layer = ot.block_average(self.m[n_slice], level)
+        xs, ys = ot.block_axis(self.xs, level), ot.block_axis(self.ys, level)
+
+        rgb_map = ot.generate_colours(m_layer, colour_model='rgb')
+        xmin, xmax = (np.min(self.xs) - 0.5 * self.mesh.cell[0] * 1e9,
+                      np.max(self.xs) + 0.5 * self.mesh.cell[0] * 1e9)
+        ymin, ymax = (np.min(self.ys) - 0.5 * self.mesh.cell[1] * 1e9,
+                      np.max(self.ys) + 0.5 * self.mesh.cell[1] * 1e9)
+        ax.imshow(rgb_map,
                   extent=[xmin, xmax, ymin, ymax]
                   )
 
-        # Filter for the arrows:
-        arr_fltr_tmp = np.zeros(len(self.xs))
-        arr_fltr_tmp[::arrow_stride] = 1
-        arr_fltr = np.zeros_like(self.x[z_filter]).reshape(len(self.xs), -1)
-        arr_fltr[::arrow_stride] = arr_fltr_tmp
-        arr_fltr = arr_fltr.astype(np.bool).reshape(-1,)
-
-        ax.quiver(self.x[z_filter][arr_fltr],
-                  self.y[z_filter][arr_fltr],
-                  self.mx[z_filter][arr_fltr],
-                  self.my[z_filter][arr_fltr],
+        # Arrows at the same positions (approximately) at every level
+        s = max(1, int(round(arrow_stride / level)))
+        X, Y = np.meshgrid(xs[::s], ys[::s])
+        ax.quiver(X, Y,
+                  m_layer[::s, ::s, 0],
+                  m_layer[::s, ::s, 1],
                   # scale=None
                   scale_units='xy', angles='xy', scale=0.1
                   )
 
         plt.show()
 
-    def save_data(self, filename='type_II_bubble'):
+    @timed('save_data')
+    def save_data(self, filename='type_II_bubble', data_format='binary 8',
+                  text_files=False):
+        """
+        Saves the magnetisation field (in A/m) as the OMF file
+        filename.omf, which can be read with oommf_tools.OOMMFDataRead or
+        used as the initial state of OOMMF with Oxs_FileVectorField
 
-        self.compute_magnetisation()
+        data_format     :: 'binary 8', 'binary 4' or 'text'
+        text_files      :: save instead the coordinates and the normalised
+                           mx, my, mz in the text files
+                           filename_coordinates.txt, filename_mx.txt, ...
+
+        Returns the path of the OMF file (None with text_files)
+        """
+        if text_files:
+            self.compute_magnetisation()
 
-        np.savetxt('{}_coordinates.txt'.format(filename), self.coordinates)
+            np.savetxt('{}_coordinates.txt'.format(filename),
+                       self.coordinates)
 
-        np.savetxt('{}_mx.txt'.format(filename), self.mx)
-        np.savetxt('{}_my.txt'.format(filename), self.my)
-        np.savetxt('{}_mz.txt'.format(filename), self.mz)
+            np.savetxt('{}_mx.txt'.format(filename), self.mx)
+            np.savetxt('{}_my.txt'.format(filename), self.my)
+            np.savetxt('{}_mz.txt'.format(filename), self.mz)
+            return None
+
+        # The field array has shape (nx, ny, nz, 3), and OMF files are in
+        # the (nz, ny, nx, 3) order
+        omf_file = '{}.omf'.format(filename)
+        ot.write_omf(omf_file, self.system.m.array.transpose(2, 1, 0, 3),
+                     self.geometry, data_format=data_format,
+                     title='{} magnetisation'.format(self.system.name))
+        return omf_file
+
+
+# -----------------------------------------------------------------------------
+# Sweeps of IsolatedBubble simulations
+
+
+def field_sweep(bubble, fields, output_folder=None, data_format='binary 8',
+                coarse_factors=()):
+    """
+    Relaxes an IsolatedBubble for the list of fields (in Tesla), in the
+    given order. Only the Zeeman term changes between fields and every
+    minimisation starts from the state relaxed at the previous field
+
+    Parameters:
+
+        bubble          :: IsolatedBubble object
+        fields          :: list of applied fields
+        output_folder   :: folder to save the relaxed states as OMF files
+                           (None to not save them)
+        data_format     :: format of the OMF files
+        coarse_factors  :: see IsolatedBubble.minimise_energy
+
+    Returns a list with a dictionary of results for every field (see
+    bubble_results), which is empty if there are no fields
+    """
+    results = []
+    for B in fields:
+        bubble.set_field(B)
+        bubble.minimise_energy(coarse_factors)
+
+        omf_file = None
+        if output_folder is not None:
+            omf_file = bubble.save_data(
+                os.path.join(output_folder, '{}_B{:04d}mT'.format(
+                    bubble.system.name, int(round(B * 1e3)))),
+                data_format=data_format)
+
+        results.append(bubble_results(bubble, omf_file))
+
+    return results
+
+
+def bubble_results(bubble, omf_file=None):
+    """
+    Returns a dictionary with the parameters of an IsolatedBubble and
+    observables of its current state (lengths in nm): bubble radius and
+    topological charge of the centre layer, and the mean magnetisation
+    """
+    k = len(bubble.zs) // 2
+    observables = oa.state_observables(bubble.m[k:k + 1], bubble.xs,
+                                       bubble.ys)
+    return {'L': bubble.L, 'thickness': bubble.thickness, 'B': bubble.B,
+            'radius': observables['radius'][0],
+            'Q': observables['Q'][0],
+            'm_mean': bubble.m.mean(axis=(0, 1, 2)),
+            'drive_time': bubble.timings['drive'][-1],
+            'omf_file': omf_file or '',
+            }
+
+
+def _limit_threads(threads):
+    # Threads of the OOMMF processes and of numerical libraries of every
+    # worker process of sweep
+    for variable in ['OOMMF_THREADS', 'OMP_NUM_THREADS',
+                     'OPENBLAS_NUM_THREADS', 'MKL_NUM_THREADS']:
+        os.environ[variable] = str(threads)
+
+
+def _sweep_branch(index, branch, fields, output_folder, data_format,
+                  coarse_factors, bubble_kwargs):
+    kwargs = dict(bubble_kwargs)
+    kwargs.update(branch)
+    # The index keeps the names unique when branches differ in other
+    # arguments than L and thickness, e.g. A or the cell size
+    L = int(round(kwargs.get('L', 400e-9) * 1e9))
+    thickness = int(round(kwargs.get('thickness', 100e-9) * 1e9))
+    name = 'oommf_typeII_bubble_L{}nm_t{}nm_branch{}'
+    kwargs.setdefault('name', name.format(L, thickness, index))
+
+    bubble = IsolatedBubble(B=fields[0], **kwargs)
+    return field_sweep(bubble, fields, output_folder, data_format,
+                       coarse_factors)
+
+
+def sweep(branches, fields, processes=None, threads=None,
+          output='bubble_sweep.npz', output_folder=None,
+          data_format='binary 8', coarse_factors=(), **bubble_kwargs):
+    """
+    Field sweeps of IsolatedBubble simulations for several geometries
+    (branches), e.g. sample sizes. Every branch is a field_sweep of a
+    single IsolatedBubble, thus the mesh and system are built once and
+    fields are warm started. Branches run in parallel in a pool of
+    processes, each one with a system of unique name
+
+    Parameters:
+
+        branches        :: list of dictionaries with IsolatedBubble
+                           arguments, e.g. [{'L': 400e-9}, {'L': 600e-9}].
+                           If there is no name, it is made from L,
+                           thickness and the index of the branch
+        fields          :: list of applied fields (in Tesla)
+        processes       :: number of worker processes (default: one per
+                           branch, up to the number of cores)
+        threads         :: OOMMF threads of every worker (default: the
+                           cores divided by the processes)
+        output          :: npz file to save the results (None to not save
+                           them)
+        output_folder   :: folder to save the relaxed states as OMF files
+        bubble_kwargs   :: arguments of IsolatedBubble shared by branches
+
+    Returns a dictionary of arrays with one row per branch and field (see
+    bubble_results), which is saved in the npz file
+    """
+    fields = list(fields)
+    if not fields or not branches:
+        raise ValueError('Specify at least one field and one branch')
+
+    cores = os.cpu_count()
+    if processes is None:
+        processes = max(1, min(len(branches), cores))
+    if threads is None:
+        threads = max(1, cores // processes)
+    if output_folder is not None and not os.path.exists(output_folder):
+        os.makedirs(output_folder)
+
+    with ProcessPoolExecutor(max_workers=processes,
+                             initializer=_limit_threads,
+                             initargs=(threads,)) as executor:
+        futures = [executor.submit(_sweep_branch, index, branch, fields,
+                                   output_folder, data_format,
+                                   coarse_factors, bubble_kwargs)
+                   for index, branch in enumerate(branches)]
+        rows = [r for future in futures for r in future.result()]
+
+    results = {k: np.array([r[k] for r in rows]) for k in rows[0]}
+
+    if output is not None:
+        np.savez_compressed(output, **results)
+
+    return results
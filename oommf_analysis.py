@@ -0,0 +1,490 @@
+import numpy as np
+import scipy.ndimage as ndi
+
+import oommf_tools as ot
+
+
+# -----------------------------------------------------------------------------
+# Observables of the magnetisation states, computed for all the z-layers of a
+# state at once. The magnetisation is an (nz, ny, nx, 3) array as the m
+# attribute of oommf_tools.OOMMFDataRead and lengths are in nm
+
+
+def topological_charge_density(m, dx, dy):
+    """
+    Returns the topological charge density of every layer
+
+        q = (1 / 4 pi) m . (dm/dx x dm/dy)
+
+    m       ::  (nz, ny, nx, 3) array
+    dx, dy  ::  cell sizes
+
+    The result is an (nz, ny, nx) array
+    """
+    dm_dx = np.gradient(m, dx, axis=2)
+    dm_dy = np.gradient(m, dy, axis=1)
+    return np.einsum('...i,...i', m, np.cross(dm_dx, dm_dy)) / (4 * np.pi)
+
+
+def block_mean(a, stride):
+    """
+    Returns the mean of the stride x stride blocks of the last two axes of
+    the array a. Cells out of the last full block are left out
+    """
+    if stride == 1:
+        return a
+    ny, nx = (a.shape[-2] // stride) * stride, (a.shape[-1] // stride) * stride
+    blocks = a[..., :ny, :nx].reshape(a.shape[:-2] + (ny // stride, stride,
+                                                      nx // stride, stride))
+    return blocks.mean(axis=(-3, -1))
+
+
+def topological_charge(m, dx, dy):
+    """
+    Returns the integrated topological charge of every layer of the
+    (nz, ny, nx, 3) array m, as an array of length nz
+    """
+    return topological_charge_density(m, dx, dy).sum(axis=(1, 2)) * dx * dy
+
+
+def zero_crossings(profiles, xs, x0=0.0):
+    """
+    Returns the positions where the profiles (array with shape (..., nx))
+    change sign, closest to x0 at its left and at its right. Positions
+    are linearly interpolated and they are NaN when there is no crossing
+
+    Returns the (left, right) arrays with shape (...)
+    """
+    a, b = profiles[..., :-1], profiles[..., 1:]
+    crossing = np.signbit(a) != np.signbit(b)
+
+    # Interpolated positions of every sign change
+    with np.errstate(divide='ignore', invalid='ignore'):
+        t = a / (a - b)
+    x_cross = xs[:-1] + t * (xs[1:] - xs[:-1])
+
+    left_mask = crossing & (x_cross <= x0)
+    right_mask = crossing & (x_cross > x0)
+
+    left = np.where(left_mask, x_cross, -np.inf).max(axis=-1)
+    right = np.where(right_mask, x_cross, np.inf).min(axis=-1)
+
+    left[~np.isfinite(left)] = np.nan
+    right[~np.isfinite(right)] = np.nan
+
+    return left, right
+
+
+def bubble_radius(mz_profiles, xs, x0=0.0):
+    """
+    Returns the bubble radius from the m_z = 0 crossings of the m_z
+    profiles (..., nx) across the bubble centre at x0
+    """
+    left, right = zero_crossings(mz_profiles, xs, x0)
+    return 0.5 * (right - left)
+
+
+def state_observables(m, xs, ys, centre=(0.0, 0.0), q_stride=1):
+    """
+    Returns a dictionary with the observables of every layer of the
+    magnetisation m (an (nz, ny, nx, 3) array):
+
+        mz_profile  ::  (nz, nx) m_z along x through the centre
+        radius      ::  (nz,) bubble radius from the m_z = 0 crossings
+        Q           ::  (nz,) integrated topological charge
+        q_density   ::  (nz, ny // q_stride, nx // q_stride) topological
+                        charge density, averaged over blocks of q_stride x
+                        q_stride cells (see block_mean)
+        m_mean      ::  (nz, 3) average magnetisation
+    """
+    j = np.argmin(np.abs(ys - centre[1]))
+    mz_profile = m[:, j, :, 2].copy()
+    dx, dy = xs[1] - xs[0], ys[1] - ys[0]
+    q_density = topological_charge_density(m, dx, dy)
+
+    return {'mz_profile': mz_profile,
+            'radius': bubble_radius(mz_profile, xs, centre[0]),
+            'Q': q_density.sum(axis=(1, 2)) * dx * dy,
+            'q_density': block_mean(q_density, q_stride),
+            'm_mean': m.mean(axis=(1, 2)),
+            }
+
+
+def extract_observables(series, output='observables.npz',
+                        centre=(0.0, 0.0), q_stride=4):
+    """
+    Computes the observables (see state_observables) of all the states of
+    a sweep and saves them in a single compressed npz file, with one row
+    per state:
+
+        parameters from the file paths (e.g. 'Bz')  ::  (n_states,)
+        files                                       ::  (n_states,)
+        mz_profile                                  ::  (n_states, nz, nx)
+        radius, Q                                   ::  (n_states, nz)
+        q_density                                   ::  (n_states, nz,
+                                                         nyq, nxq)
+        m_mean                                      ::  (n_states, nz, 3)
+
+    plus the x and z coordinates, and the x_q and y_q coordinates of the
+    centres of the blocks of q_density. Lengths are in nm
+
+    Parameters:
+
+        series      :: an oommf_tools.OMFSeries or a folder / glob pattern
+        output      :: npz file to save the results (None to not save them)
+        centre      :: (x, y) position of the bubble centre in nm
+        q_stride    :: size (in cells) of the blocks where the topological
+                       charge density is averaged, to reduce the file size
+
+    Returns the dictionary of arrays
+    """
+    if not isinstance(series, ot.OMFSeries):
+        series = ot.OMFSeries(series)
+
+    observables = {}
+    for parameters, omf_file in series:
+        omf_file.read_m()
+        state = state_observables(omf_file.m, series.xs, series.ys, centre,
+                                  q_stride)
+        # Release the magnetisation of this state
+        del omf_file.m, omf_file.mx, omf_file.my, omf_file.mz
+
+        for k, v in state.items():
+            observables.setdefault(k, []).append(v)
+
+    results = {k: np.array(v) for k, v in observables.items()}
+
+    parameter_names = []
+    for p in series.parameters:
+        parameter_names += [k for k in p.keys() if k not in parameter_names]
+    for k in parameter_names:
+        results[k] = np.array([p.get(k, np.nan) for p in series.parameters])
+
+    results['files'] = np.array(series.files)
+    results['x'] = series.xs
+    results['z'] = series.zs
+    for k, xs in [('x_q', series.xs), ('y_q', series.ys)]:
+        n = (len(xs) // q_stride) * q_stride
+        results[k] = xs[:n].reshape(-1, q_stride).mean(axis=1)
+
+    if output is not None:
+        np.savez_compressed(output, **results)
+
+    return results
+
+
+def load_observables(input_file='observables.npz'):
+    """
+    Returns the dictionary of arrays saved by extract_observables
+    """
+    with np.load(input_file) as data:
+        return {k: data[k] for k in data.files}
+
+
+# -----------------------------------------------------------------------------
+# Classification of the relaxed states of a sweep
+
+
+STATE_CLASSES = ('uniform', 'isolated bubble', 'bubble lattice', 'stripes')
+
+
+def domain_shape_factors(mask, min_area=4):
+    """
+    Labels the connected domains (4-neighbours) of the boolean (ny, nx)
+    array mask and returns their areas (in cells) and shape factors
+    P^2 / (16 A), where P is the number of edges at the domain boundary.
+    The shape factor is 1 for squares, about 1.3 for discs and l / (4 w)
+    for stripes of length l and width w. Domains smaller than min_area are
+    ignored
+
+    Returns the (areas, shape_factors) arrays
+    """
+    labels, n_domains = ndi.label(mask)
+    areas = np.bincount(labels.ravel(), minlength=n_domains + 1)[1:]
+    perimeters = boundary_edges(labels, n_domains, axes=(0, 1))
+
+    keep = areas >= min_area
+    areas, perimeters = areas[keep], perimeters[keep]
+
+    return areas, perimeters ** 2 / (16. * areas)
+
+
+def boundary_edges(labels, n_labels, axes):
+    """
+    Returns the number of boundary edges along the axes of every label
+    (1 to n_labels) of the labels array, i.e. edges between a cell of the
+    label and a cell with another label. Edges at the sample boundary are
+    not counted
+    """
+    edges = np.zeros(n_labels + 1)
+    for axis in axes:
+        a = np.moveaxis(labels, axis, 0)
+        diff = a[1:] != a[:-1]
+        edges += np.bincount(a[1:][diff], minlength=n_labels + 1)
+        edges += np.bincount(a[:-1][diff], minlength=n_labels + 1)
+    return edges[1:]
+
+
+def classify_state(mz, min_fraction=0.002, min_area=4, stripe_factor=2.):
+    """
+    Classifies a state from its (ny, nx) m_z map (e.g. the centre layer)
+    as one of STATE_CLASSES, from the domains of the minority out-of-plane
+    direction (reversed domains):
+
+        uniform         ::  reversed cells are less than min_fraction
+        stripes         ::  a domain has a shape factor larger than
+                            stripe_factor (see domain_shape_factors)
+        isolated bubble ::  a single compact domain
+        bubble lattice  ::  several compact domains
+
+    Returns a dictionary with the class and the features: the fraction of
+    reversed cells, the number of domains and their maximum shape factor
+    """
+    mask = np.asarray(mz) < 0
+    fraction = mask.mean()
+    if fraction > 0.5:
+        mask = ~mask
+        fraction = 1 - fraction
+
+    areas, shape_factors = domain_shape_factors(mask, min_area)
+    features = {'fraction': float(fraction),
+                'n_domains': len(areas),
+                'max_shape_factor': float(shape_factors.max())
+                if len(areas) else 0.}
+
+    if fraction < min_fraction or len(areas) == 0:
+        state_class = 'uniform'
+    elif features['max_shape_factor'] > stripe_factor:
+        state_class = 'stripes'
+    elif len(areas) == 1:
+        state_class = 'isolated bubble'
+    else:
+        state_class = 'bubble lattice'
+
+    features['class'] = state_class
+    return features
+
+
+def classify_omf(omf_file, z_index=None, **kwargs):
+    """
+    Classifies the state of an OMF file (see classify_state) from its
+    z-layer z_index (by default the centre layer). Only this layer is read
+    """
+    if not isinstance(omf_file, ot.OOMMFDataRead):
+        omf_file = ot.OOMMFDataRead(omf_file)
+    if z_index is None:
+        z_index = omf_file.nz // 2
+    return classify_state(omf_file.read_layer(z_index)[..., 2], **kwargs)
+
+
+# -----------------------------------------------------------------------------
+# Census of the reversed domains of the states of an ensemble, e.g. the
+# random films of several seeds relaxed at every field
+
+
+DOMAIN_KINDS = ('bubble', 'biskyrmion', 'stripe')
+
+
+def _label_sums(labels, n_labels, weights):
+    # Sums of the weights (broadcast to the shape of labels) of every label
+    weights = np.broadcast_to(weights, labels.shape).ravel()
+    return np.bincount(labels.ravel(), weights=weights,
+                       minlength=n_labels + 1)[1:]
+
+
+def domain_regions(labels, sampling, layers=False):
+    """
+    Returns the labels array where every cell outside the domains has the
+    label of the closest domain cell (distances scaled with sampling, the
+    cell sizes). With layers, cells only take labels of their own z-layer
+    (the first axis) and layers without domains stay 0
+    """
+    if not labels.any():
+        return labels
+    if layers:
+        # Distances across layers larger than any distance within a layer
+        sampling = (1e6 * max(sampling[1:]),) + tuple(sampling[1:])
+    indices = ndi.distance_transform_edt(labels == 0, sampling=sampling,
+                                         return_distances=False,
+                                         return_indices=True)
+    regions = labels[tuple(indices)]
+    if layers:
+        regions[indices[0] != np.arange(labels.shape[0])[:, None, None]] = 0
+    return regions
+
+
+def domain_census(m, xs, ys, zs, mz_sign=None, min_cells=4,
+                  stripe_factor=2.):
+    """
+    Labels the reversed domains of the magnetisation m (an (nz, ny, nx, 3)
+    array) with connected components, as 2D domains of every z-layer
+    (4-neighbours) and as 3D domains through the thickness (6-neighbours),
+    without periodic boundaries. Reversed cells have m_z with the sign
+    opposite to mz_sign, by default the sign of the mean m_z
+
+    The topological charge of a domain is integrated over its region: the
+    cells closer to it than to any other domain (see domain_regions), thus
+    it includes the domain walls and it is about 1 for bubbles (skyrmion
+    bubbles), 2 for biskyrmions and 0 for type II bubbles. For 3D domains
+    it is the charge averaged over the layers. 2D domains are classified
+    as one of DOMAIN_KINDS: stripes have a shape factor (see
+    domain_shape_factors) larger than stripe_factor, and the other domains
+    are biskyrmions if |Q| rounds to 2 or more, or bubbles. Domains with
+    less than min_cells cells are ignored. Lengths are in the units of the
+    coordinates xs, ys, zs
+
+    Returns two dictionaries of arrays, with one element per 2D domain:
+
+        layer           ::  z-layer index
+        area            ::  area
+        x, y            ::  centroid
+        radius          ::  radius of a disc with the same area
+        Q               ::  topological charge
+        shape_factor    ::  see domain_shape_factors
+        kind            ::  one of DOMAIN_KINDS
+
+    and per 3D domain:
+
+        volume          ::  volume
+        x, y, z         ::  centroid
+        n_layers        ::  number of layers spanned by the domain
+        radius          ::  radius of a cylinder with the same volume and
+                            the height of the spanned layers
+        Q               ::  topological charge (averaged over the layers)
+        through         ::  the domain spans all the layers
+    """
+    nz = m.shape[0]
+    dx, dy = xs[1] - xs[0], ys[1] - ys[0]
+    dz = zs[1] - zs[0] if nz > 1 else 1.
+    sampling = (dz, dy, dx)
+    X, Y, Z = (xs[None, None, :], ys[None, :, None], zs[:, None, None])
+
+    mz = m[..., 2]
+    if mz_sign is None:
+        mz_sign = 1. if mz.mean() >= 0 else -1.
+    mask = mz * mz_sign < 0
+    q = topological_charge_density(m, dx, dy) * dx * dy
+
+    # 2D domains: connected only within every layer
+    structure = np.zeros((3, 3, 3), dtype=bool)
+    structure[1] = ndi.generate_binary_structure(2, 1)
+    labels, n = ndi.label(mask, structure)
+
+    cells = np.bincount(labels.ravel(), minlength=n + 1)[1:]
+    area = cells * dx * dy
+    perimeters = boundary_edges(labels, n, axes=(1, 2))
+    shape_factor = perimeters ** 2 / (16. * np.maximum(cells, 1))
+    Q = _label_sums(domain_regions(labels, sampling, layers=True), n, q)
+
+    layers = {'layer': _label_sums(labels, n, np.arange(nz)[:, None, None])
+                       / np.maximum(cells, 1),
+              'area': area,
+              'x': _label_sums(labels, n, X) / np.maximum(cells, 1),
+              'y': _label_sums(labels, n, Y) / np.maximum(cells, 1),
+              'radius': np.sqrt(area / np.pi),
+              'Q': Q,
+              'shape_factor': shape_factor,
+              }
+    layers['layer'] = np.round(layers['layer']).astype(int)
+    kinds = np.where(np.round(np.abs(Q)) >= 2, 'biskyrmion', 'bubble')
+    layers['kind'] = np.where(shape_factor > stripe_factor, 'stripe', kinds)
+    keep = cells >= min_cells
+    layers = {k: v[keep] for k, v in layers.items()}
+
+    # 3D domains: connected through the thickness
+    labels, n = ndi.label(mask)
+
+    cells = np.bincount(labels.ravel(), minlength=n + 1)[1:]
+    # Layers spanned by every domain
+    in_layer = np.zeros((nz, n + 1), dtype=bool)
+    in_layer[np.nonzero(labels)[0], labels[labels > 0]] = True
+    n_layers = in_layer[:, 1:].sum(axis=0)
+    Q = _label_sums(domain_regions(labels, sampling), n, q) / nz
+
+    volumes = {'volume': cells * dx * dy * dz,
+               'x': _label_sums(labels, n, X) / np.maximum(cells, 1),
+               'y': _label_sums(labels, n, Y) / np.maximum(cells, 1),
+               'z': _label_sums(labels, n, Z) / np.maximum(cells, 1),
+               'n_layers': n_layers,
+               'radius': np.sqrt(cells * dx * dy / (np.pi *
+                                                    np.maximum(n_layers, 1))),
+               'Q': Q,
+               'through': n_layers == nz,
+               }
+    keep = cells >= min_cells
+    volumes = {k: v[keep] for k, v in volumes.items()}
+
+    return layers, volumes
+
+
+def ensemble_census(series, output='domain_census.npz', z_index=None,
+                    **kwargs):
+    """
+    Census of the reversed domains (see domain_census) of all the states of
+    an ensemble, e.g. all the seeds and fields of the random films:
+
+        ensemble_census('film_random_rseed*_field-sweep_omfs/*.omf')
+
+    The results are saved in a compressed npz file with the tables:
+
+        domains     ::  one row per 2D domain, with the index of its state
+        domains_3d  ::  one row per 3D domain, with the index of its state
+        states      ::  one row per state, with the parameters of the file
+                        paths (e.g. rseed and stage) and the numbers of
+                        domains of every kind in the layer z_index (by
+                        default the centre layer), of 3D domains and of 3D
+                        domains through the thickness
+        files       ::  files of the states
+
+    Tables are numpy structured arrays, e.g. census['states']['n_bubble'].
+    Returns the dictionary of tables
+    """
+    if not isinstance(series, ot.OMFSeries):
+        series = ot.OMFSeries(series)
+    if z_index is None:
+        z_index = series.nz // 2
+
+    parameter_names = []
+    for p in series.parameters:
+        parameter_names += [k for k in p.keys() if k not in parameter_names]
+
+    domains, domains_3d, states = [], [], []
+    for i, (parameters, omf_file) in enumerate(series):
+        omf_file.read_m()
+        layers, volumes = domain_census(omf_file.m, series.xs, series.ys,
+                                        series.zs, **kwargs)
+        del omf_file.m, omf_file.mx, omf_file.my, omf_file.mz
+
+        layers['state'] = np.full(len(layers['Q']), i)
+        volumes['state'] = np.full(len(volumes['Q']), i)
+        domains.append(layers)
+        domains_3d.append(volumes)
+
+        centre = layers['layer'] == z_index
+        state = [parameters.get(k, np.nan) for k in parameter_names]
+        state += [np.sum(layers['kind'][centre] == kind)
+                  for kind in DOMAIN_KINDS]
+        state += [len(volumes['Q']), np.sum(volumes['through'])]
+        states.append(tuple(state))
+
+    def table(rows):
+        columns = {k: np.concatenate([r[k] for r in rows]) for k in rows[0]}
+        dtype = [(k, 'U16' if k == 'kind' else v.dtype)
+                 for k, v in columns.items()]
+        result = np.empty(len(columns['state']), dtype=dtype)
+        for k, v in columns.items():
+            result[k] = v
+        return result
+
+    dtype = ([(k, float) for k in parameter_names] +
+             [('n_' + kind, int) for kind in DOMAIN_KINDS] +
+             [('n_3d', int), ('n_through', int)])
+    results = {'domains': table(domains),
+               'domains_3d': table(domains_3d),
+               'states': np.array(states, dtype=dtype),
+               'files': np.array(series.files)}
+
+    if output is not None:
+        np.savez_compressed(output, **results)
+
+    return results
@@ -0,0 +1,180 @@
+import numpy as np
+import os
+import multiprocessing
+import matplotlib
+import matplotlib.style
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+
+import oommf_tools as ot
+
+
+# -----------------------------------------------------------------------------
+# Rendering of z-layers of OMF files into PNG images
+
+
+class LayerRenderer(object):
+    """
+    Class to plot a z-layer of OMF files with the same mesh, as an image with
+    the HSL colour map of the magnetisation plus arrows with the in-plane
+    components. A single Agg figure is created and its image and arrows are
+    updated for every file
+
+    Parameters:
+
+        omf_file        :: OOMMFDataRead object to get the mesh from
+        z_index         :: index of the plotted layer
+        arrow_stride    :: plot an arrow every arrow_stride cells
+        figsize         :: figure size in inches
+        dpi             :: resolution of the PNG images
+        quiver_scale    :: scale of the arrows (see matplotlib's quiver)
+        level           :: level of detail (see oommf_tools.LODPyramid): 1
+                           for the full resolution, or 'auto' to use the
+                           coarsest level with at least as many cells as
+                           pixels along the width of the figure
+    """
+
+    def __init__(self, omf_file, z_index=20, arrow_stride=5,
+                 figsize=(12, 12), dpi=150, quiver_scale=0.05, level=1):
+
+        self.z_index = z_index
+        self.dpi = dpi
+
+        if level == 'auto':
+            level = ot.lod_level(omf_file.nx, figsize[0] * dpi)
+        self.level = level
+        # Arrows at the same positions (approximately) at every level
+        self.arrow_stride = max(1, int(round(arrow_stride / level)))
+
+        xs = ot.block_axis(omf_file.xs, level)
+        ys = ot.block_axis(omf_file.ys, level)
+
+        self.figure = Figure(figsize=figsize)
+        FigureCanvasAgg(self.figure)
+        self.ax = self.figure.add_subplot(111)
+
+        # RGBA image of the layer and temporary arrays of the colours,
+        # reused for every frame
+        self.rgba = np.zeros((len(ys), len(xs), 4), dtype=np.uint8)
+        self.workspace = {}
+        self.image = self.ax.imshow(self.rgba,
+                                    extent=[omf_file.xmin * 1e9,
+                                            omf_file.xmax * 1e9,
+                                            omf_file.ymin * 1e9,
+                                            omf_file.ymax * 1e9,
+                                            ],
+                                    origin='lower'
+                                    )
+
+        s = self.arrow_stride
+        X, Y = np.meshgrid(xs[::s], ys[::s])
+        self.arrows = self.ax.quiver(X, Y,
+                                     np.zeros_like(X), np.zeros_like(Y),
+                                     scale_units='xy', angles='xy',
+                                     scale=quiver_scale
+                                     )
+
+    def render(self, omf_file, png_file):
+        """
+        Plots the layer of the omf_file (an OOMMFDataRead object) and saves
+        it in png_file. The image is written to a temporary file which is
+        then renamed, so an interrupted run does not leave incomplete PNGs
+        """
+        if self.level == 1:
+            m_layer = omf_file.read_layer(self.z_index)
+            ot.generate_colours(m_layer, colour_model='rgba', out=self.rgba,
+                                workspace=self.workspace)
+        else:
+            lod = ot.LODPyramid(omf_file)
+            m_layer = lod.m(self.z_index, self.level)
+            self.rgba[...] = lod.rgba(self.z_index, self.level)
+        self.image.set_data(self.rgba)
+
+        s = self.arrow_stride
+        self.arrows.set_UVC(m_layer[::s, ::s, 0], m_layer[::s, ::s, 1])
+
+        tmp_file = os.path.join(os.path.dirname(png_file),
+                                '.{}.{}.tmp'.format(os.path.basename(png_file),
+                                                    os.getpid()))
+        try:
+            self.figure.savefig(tmp_file, format='png',
+                                dpi=self.dpi, bbox_inches='tight')
+            os.replace(tmp_file, png_file)
+        finally:
+            if os.path.exists(tmp_file):
+                os.remove(tmp_file)
+
+        return png_file
+
+
+# Renderers of a worker process, one for every mesh geometry
+_RENDERERS = {}
+_RENDERER_KWARGS = {}
+
+
+def _init_worker(renderer_kwargs, style):
+    _RENDERER_KWARGS.update(renderer_kwargs)
+    if style is not None:
+        matplotlib.style.use(style)
+
+
+def _render_job(job):
+    omf_path, png_file = job
+    omf_file = ot.OOMMFDataRead(omf_path)
+
+    geometry = omf_file.geometry()
+    if geometry not in _RENDERERS:
+        _RENDERERS[geometry] = LayerRenderer(omf_file, **_RENDERER_KWARGS)
+
+    return _RENDERERS[geometry].render(omf_file, png_file)
+
+
+def render_states(jobs, processes=None, style=None, overwrite=False,
+                  **renderer_kwargs):
+    """
+    Renders a list of (omf_file, png_file) paths using a pool of processes.
+    This is a generator that yields the PNG files as they are written
+
+    Parameters:
+
+        jobs            :: list of (OMF path, PNG path) tuples
+        processes       :: number of worker processes (default: all cores)
+        style           :: matplotlib style applied in every worker
+        overwrite       :: if False, skip the PNG files that already exist
+        renderer_kwargs :: options for LayerRenderer, e.g. z_index
+
+    Example:
+
+        jobs = [(f, f.replace('.omf', '.png')) for f in series.files]
+        for png_file in render_states(jobs, processes=8, z_index=20):
+            print(png_file)
+    """
+    if not overwrite:
+        jobs = [job for job in jobs if not os.path.exists(job[1])]
+
+    if not jobs:
+        return
+
+    if processes is None:
+        processes = os.cpu_count()
+    processes = max(1, min(processes, len(jobs)))
+
+    # Check the style here: a pool whose initializer fails restarts its
+    # workers forever instead of raising the error
+    if style is not None:
+        with matplotlib.style.context(style):
+            pass
+
+    pool = multiprocessing.Pool(processes,
+                                initializer=_init_worker,
+                                initargs=(renderer_kwargs, style))
+    try:
+        chunksize = max(1, len(jobs) // (4 * processes))
+        for png_file in pool.imap_unordered(_render_job, jobs, chunksize):
+            yield png_file
+        pool.close()
+    except BaseException:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
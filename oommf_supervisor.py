@@ -0,0 +1,441 @@
+import numpy as np
+import os
+import signal
+import shlex
+import json
+import time
+import asyncio
+
+import oommf_tools as ot
+import oommf_sweep as osw
+
+
+# -----------------------------------------------------------------------------
+# Supervision of OOMMF runs: the ODT files are followed while boxsi runs, and
+# runs that stall, diverge or exceed their budget are stopped (or flagged)
+
+
+class ODTTail(object):
+    """
+    Class to read the rows appended to an ODT file since the last read, e.g.
+    while OOMMF is writing it
+
+    Parameters:
+
+        input_file      :: ODT file (it does not need to exist yet)
+    """
+
+    def __init__(self, input_file):
+        self.input_file = input_file
+        self.offset = 0
+        self.buffer = b''
+        self.columns = None
+
+    def read(self):
+        """
+        Returns the new complete rows as an (n, n_columns) array (n can be
+        zero). Column names are in self.columns once the header is read
+        """
+        if not os.path.exists(self.input_file):
+            return np.empty((0, 0))
+
+        if os.path.getsize(self.input_file) < self.offset:
+            # The file was written again from the beginning
+            self.offset, self.buffer, self.columns = 0, b'', None
+
+        with open(self.input_file, 'rb') as f:
+            f.seek(self.offset)
+            data = f.read()
+        self.offset += len(data)
+
+        # The last line can be incomplete
+        lines = (self.buffer + data).split(b'\n')
+        self.buffer = lines.pop()
+
+        rows = []
+        for line in lines:
+            line = line.decode('latin-1').strip()
+            if line.startswith('#'):
+                if line[1:].lstrip().startswith('Columns:'):
+                    names = ot.split_tcl_list(line.split(':', 1)[1])
+                    self.columns = {n.strip(): i for i, n in enumerate(names)}
+            elif line:
+                rows.append(line)
+
+        if not rows or self.columns is None:
+            return np.empty((0, len(self.columns or [])))
+
+        return np.fromstring(' '.join(rows), sep=' ').reshape(
+            len(rows), -1)
+
+    def column(self, rows, name):
+        """
+        Returns the values of the column name of rows (None if the column
+        is not in the file)
+        """
+        if self.columns is None or name not in self.columns:
+            return None
+        return rows[:, self.columns[name]]
+
+
+class ConvergenceMonitor(object):
+    """
+    Class to follow the convergence of a MinDriver run from the ODT rows
+
+    A run is stalled when the max mxHxm has not decreased by a fraction
+    stall_tolerance of its lowest value during the last stall_iterations
+    iterations, and the total energy changed less than energy_tolerance
+    (relative) in those iterations, e.g. runs oscillating above
+    stopping_mxHxm. It diverged when values are not finite or the max mxHxm
+    grows divergence_factor times above its lowest value. References are
+    reset at every stage of the driver
+
+    Parameters:
+
+        stall_iterations    :: iterations without improvement
+        stall_tolerance     :: relative decrease of max mxHxm
+        energy_tolerance    :: relative change of the energy
+        divergence_factor   :: growth of the max mxHxm
+    """
+
+    def __init__(self, stall_iterations=20000, stall_tolerance=0.05,
+                 energy_tolerance=1e-6, divergence_factor=1e3):
+        self.stall_iterations = stall_iterations
+        self.stall_tolerance = stall_tolerance
+        self.energy_tolerance = energy_tolerance
+        self.divergence_factor = divergence_factor
+
+        self.stage = None
+        self.iteration = None
+        self.max_mxHxm = None
+        self.energy = None
+        self.state = 'running'
+        self.reset()
+
+    def reset(self):
+        # Lowest max mxHxm of the stage and where the last improvement was
+        self.best_mxHxm = np.inf
+        self.best_iteration = None
+        self.best_energy = None
+        self.min_mxHxm = np.inf
+
+    def update(self, iterations, max_mxHxm, energies, stages=None):
+        """
+        Updates the monitor with arrays of new ODT values and returns the
+        state: 'running', 'stalled' or 'diverged'
+        """
+        if stages is None:
+            stages = np.zeros(len(iterations))
+
+        for it, mxhxm, energy, stage in zip(iterations, max_mxHxm, energies,
+                                            stages):
+            if stage != self.stage:
+                self.stage = stage
+                self.reset()
+            self.iteration, self.max_mxHxm, self.energy = it, mxhxm, energy
+
+            if not (np.isfinite(mxhxm) and np.isfinite(energy)):
+                self.state = 'diverged'
+                return self.state
+
+            self.min_mxHxm = min(self.min_mxHxm, mxhxm)
+            if mxhxm > self.divergence_factor * self.min_mxHxm:
+                self.state = 'diverged'
+                return self.state
+
+            if mxhxm < self.best_mxHxm * (1 - self.stall_tolerance):
+                self.best_mxHxm = mxhxm
+                self.best_iteration, self.best_energy = it, energy
+
+        if self.best_iteration is not None and self.iteration is not None:
+            scale = max(abs(self.energy), abs(self.best_energy))
+            energy_change = (abs(self.energy - self.best_energy) / scale
+                             if scale > 0 else 0.)
+            if (self.iteration - self.best_iteration > self.stall_iterations
+                    and energy_change < self.energy_tolerance):
+                self.state = 'stalled'
+
+        return self.state
+
+
+class SweepSupervisor(object):
+    """
+    Class to run SweepJob objects (or continuation chains of them, see
+    oommf_sweep.run_sweep) with asyncio, following their ODT files while
+    they run. Runs that stall or diverge (see ConvergenceMonitor) or exceed
+    their budget are killed, or only flagged with action='flag'. The state
+    of the sweep is written to a JSON status file every poll_interval
+    seconds, and the records of the finished runs are appended to the
+    manifest as in run_sweep, with their final status
+
+    Parameters:
+
+        jobs            :: list of SweepJob objects or lists of them
+        total_cores     :: cores available for the sweep (default: all)
+        threads         :: threads of every OOMMF process (default: see
+                           oommf_sweep.threads_per_job)
+        max_threads     :: maximum number of threads per process
+        oommf           :: command to call OOMMF
+        manifest        :: JSON lines file with the records of the runs
+        status_file     :: JSON file with the state of all the runs
+        budget          :: maximum wall time of a run in seconds (None for
+                           no limit)
+        max_iterations  :: maximum number of MinDriver iterations of a run
+        action          :: 'kill' or 'flag' the stalled, diverged or over
+                           budget runs
+        poll_interval   :: seconds between reads of the ODT files
+        monitor_kwargs  :: options for ConvergenceMonitor
+        omf_key         :: MIF parameter with the initial state OMF file
+        cache           :: skip runs that finished before (see run_sweep)
+    """
+
+    def __init__(self, jobs, total_cores=None, threads=None, max_threads=8,
+                 oommf='oommf', manifest='sweep_manifest.jsonl',
+                 status_file='sweep_status.json', budget=None,
+                 max_iterations=None, action='kill', poll_interval=10.,
+                 monitor_kwargs=None, omf_key='OMFFILE', cache=True):
+
+        if action not in ['kill', 'flag']:
+            raise Exception('Specify a valid action: kill or flag')
+
+        self.jobs = jobs
+        if total_cores is None:
+            total_cores = os.cpu_count()
+        if threads is None:
+            threads = osw.threads_per_job(len(jobs), total_cores, max_threads)
+        self.threads = threads
+        self.n_processes = max(1, total_cores // threads)
+
+        self.oommf = oommf
+        self.manifest = manifest
+        self.status_file = status_file
+        self.budget = budget
+        self.max_iterations = max_iterations
+        self.action = action
+        self.poll_interval = poll_interval
+        self.monitor_kwargs = monitor_kwargs or {}
+        self.omf_key = omf_key
+        self.cache = cache
+        self.version = osw.oommf_version(oommf) if cache else ''
+
+        # State of every job, in the order of the jobs (and chains)
+        self.states = []
+        for chain in jobs:
+            for job in ([chain] if isinstance(chain, osw.SweepJob)
+                        else chain):
+                self.states.append({'job': job, 'state': 'pending',
+                                    'flags': []})
+
+    def state_of(self, job):
+        for s in self.states:
+            if s['job'] is job:
+                return s
+
+    def write_status(self):
+        """
+        Writes the state of the sweep to the status file (it is replaced
+        atomically, so it can be read at any time)
+        """
+        if self.status_file is None:
+            return
+
+        now = time.time()
+        runs = []
+        for s in self.states:
+            run = {'basename': s['job'].basename,
+                   'parameters': s['job'].parameters,
+                   'state': s['state'],
+                   'flags': s['flags']}
+            if 'start_time' in s:
+                run['wall_time'] = s.get('wall_time', now - s['start_time'])
+            monitor = s.get('monitor')
+            if monitor is not None:
+                run.update({'iteration': monitor.iteration,
+                            'max_mxHxm': monitor.max_mxHxm,
+                            'energy': monitor.energy,
+                            'stage': monitor.stage})
+            runs.append(run)
+
+        counts = {}
+        for s in self.states:
+            counts[s['state']] = counts.get(s['state'], 0) + 1
+        summary = {'updated': time.strftime('%Y-%m-%d %H:%M:%S'),
+                   'runs': len(self.states),
+                   'states': counts,
+                   'flagged': sum(bool(s['flags']) for s in self.states),
+                   'wall_time_killed_runs': sum(
+                       s.get('wall_time', 0) for s in self.states
+                       if s['state'] == 'killed'),
+                   }
+
+        tmp_file = self.status_file + '.tmp'
+        with open(tmp_file, 'w') as f:
+            json.dump({'summary': summary, 'runs': runs}, f, indent=1,
+                      default=float)
+        os.replace(tmp_file, self.status_file)
+
+    def check(self, s):
+        """
+        Returns the reason to stop the run of the state s (or None)
+        """
+        monitor = s['monitor']
+        if monitor.state in ['stalled', 'diverged']:
+            return monitor.state
+        if (self.budget is not None and
+                time.time() - s['start_time'] > self.budget):
+            return 'over budget'
+        if (self.max_iterations is not None and monitor.iteration is not None
+                and monitor.iteration > self.max_iterations):
+            return 'over iteration budget'
+        return None
+
+    def poll(self, s):
+        rows = s['tail'].read()
+        if len(rows) == 0:
+            return
+        tail = s['tail']
+        iterations = tail.column(rows, osw.ITERATION_COLUMN)
+        max_mxHxm = tail.column(rows, osw.MXHXM_COLUMN)
+        energies = tail.column(rows, osw.ENERGY_COLUMN)
+        if iterations is None or max_mxHxm is None or energies is None:
+            return
+        s['monitor'].update(iterations, max_mxHxm, energies,
+                            tail.column(rows, 'Oxs_MinDriver::Stage'))
+
+    async def run_job(self, job, warm_start=False):
+        s = self.state_of(job)
+        command = job.command(self.threads, self.oommf)
+        key = job.cache_key(self.version) if self.cache else None
+        cached = self.cache and job.reuse_outputs(key)
+
+        s['start_time'] = time.time()
+        s['monitor'] = ConvergenceMonitor(**self.monitor_kwargs)
+        s['tail'] = ODTTail('{}.odt'.format(job.basename))
+
+        if cached:
+            returncode = 0
+            s['state'] = 'cached'
+        else:
+            if self.cache:
+                job.set_aside_outputs()
+
+            s['state'] = 'running'
+            log = (open(job.log_file, 'w') if job.log_file is not None
+                   else None)
+            try:
+                # New session to kill OOMMF and its child processes
+                process = await asyncio.create_subprocess_exec(
+                    *command, stdout=log, stderr=asyncio.subprocess.STDOUT,
+                    start_new_session=True)
+
+                while True:
+                    try:
+                        returncode = await asyncio.wait_for(
+                            process.wait(), self.poll_interval)
+                        break
+                    except asyncio.TimeoutError:
+                        pass
+
+                    self.poll(s)
+                    reason = self.check(s)
+                    if reason is not None and reason not in s['flags']:
+                        s['flags'].append(reason)
+                        if self.action == 'kill':
+                            s['state'] = 'killed'
+                            try:
+                                os.killpg(process.pid, signal.SIGKILL)
+                            except ProcessLookupError:
+                                pass
+                            returncode = await process.wait()
+                            break
+            finally:
+                if log is not None:
+                    log.close()
+
+            self.poll(s)
+            if s['state'] != 'killed':
+                s['state'] = 'finished' if returncode == 0 else 'failed'
+
+            if (self.cache and s['state'] == 'finished'
+                    and job.final_omf() is not None
+                    and job.cache_file is not None):
+                job.save_cache(key)
+
+        s['wall_time'] = time.time() - s['start_time']
+
+        record = {'mif_file': job.mif_file,
+                  'parameters': job.parameters,
+                  'threads': self.threads,
+                  'command': ' '.join(shlex.quote(c) for c in command),
+                  'returncode': returncode,
+                  'start_time': s['start_time'],
+                  'wall_time': s['wall_time'],
+                  'log_file': job.log_file,
+                  'warm_start': warm_start,
+                  'cached': cached,
+                  'cache_key': key,
+                  'status': s['state'],
+                  'flags': s['flags'],
+                  }
+        record.update(job.statistics())
+
+        if self.manifest is not None:
+            with open(self.manifest, 'a') as f:
+                f.write(json.dumps(record) + '\n')
+
+        return record
+
+    async def run_chain(self, chain, semaphore):
+        async with semaphore:
+            if isinstance(chain, osw.SweepJob):
+                chain.resample_initial_state(self.omf_key)
+                return [await self.run_job(chain)]
+
+            records = []
+            previous_omf = None
+            for job in chain:
+                if previous_omf is not None:
+                    job.parameters[self.omf_key] = previous_omf
+                job.resample_initial_state(self.omf_key)
+                records.append(await self.run_job(
+                    job, warm_start=previous_omf is not None))
+
+                if records[-1]['status'] in ['finished', 'cached']:
+                    previous_omf = job.final_omf()
+                else:
+                    previous_omf = None
+            return records
+
+    async def write_status_loop(self):
+        while True:
+            self.write_status()
+            await asyncio.sleep(self.poll_interval)
+
+    async def run_async(self):
+        semaphore = asyncio.Semaphore(self.n_processes)
+        status_task = asyncio.ensure_future(self.write_status_loop())
+        try:
+            chain_records = await asyncio.gather(
+                *[self.run_chain(chain, semaphore) for chain in self.jobs])
+        finally:
+            status_task.cancel()
+            self.write_status()
+
+        return [r for records in chain_records for r in records]
+
+    def run(self):
+        """
+        Runs the sweep and returns the list of records of the runs
+        """
+        print('Running {} jobs: {} processes with {} threads'.format(
+              len(self.jobs), min(self.n_processes, len(self.jobs)),
+              self.threads))
+        return asyncio.run(self.run_async())
+
+
+def run_supervised(jobs, **kwargs):
+    """
+    Runs a sweep with a SweepSupervisor (see its options), as run_sweep but
+    following the convergence of the runs. Returns the list of records
+    """
+    return SweepSupervisor(jobs, **kwargs).run()
@@ -0,0 +1,864 @@
+import os
+import shlex
+import itertools
+import json
+import time
+import threading
+import glob
+import hashlib
+import functools
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+import oommf_tools as ot
+import oommf_analysis as oa
+
+
+# -----------------------------------------------------------------------------
+# Utilities to run OOMMF simulations of a parameter sweep in parallel
+
+
+# ODT columns of the simulations with the MinDriver and the CG evolver
+ITERATION_COLUMN = 'Oxs_MinDriver::Iteration'
+MXHXM_COLUMN = 'Oxs_CGEvolve::Max mxHxm'
+ENERGY_COLUMN = 'Oxs_CGEvolve::Total energy'
+
+
+def parameter_grid(**axes):
+    """
+    Returns a list of dictionaries with all the combinations of the
+    parameter values, e.g.
+
+        parameter_grid(Ms=[0.4, 0.45], Bz=[0, 50, 100])
+            --> [{'Ms': 0.4, 'Bz': 0}, {'Ms': 0.4, 'Bz': 50}, ...]
+
+    The last parameter changes fastest
+    """
+    names = list(axes.keys())
+    return [dict(zip(names, values))
+            for values in itertools.product(*[axes[n] for n in names])]
+
+
+class SweepJob(object):
+    """
+    Class with the specification of an OOMMF simulation run with boxsi
+
+    Parameters:
+
+        mif_file        :: MIF script
+        parameters      :: dictionary with the values of the MIF Parameters
+                           (values are passed as strings to OOMMF, so they
+                           should be formatted beforehand)
+        log_file        :: file where boxsi output is saved. By default it
+                           is the BASENAME parameter plus '.log'
+        geometry        :: mesh geometry tuple of the simulation (see
+                           oommf_tools.mesh_geometry). If specified, initial
+                           states with a different mesh are resampled to it
+                           (see resample_initial_state)
+    """
+
+    def __init__(self, mif_file, parameters, log_file=None, geometry=None):
+        self.mif_file = mif_file
+        self.parameters = parameters
+        self.geometry = geometry
+
+        if log_file is None and 'BASENAME' in parameters:
+            log_file = '{}.log'.format(parameters['BASENAME'])
+        self.log_file = log_file
+
+    @property
+    def basename(self):
+        return self.parameters.get('BASENAME')
+
+    def final_omf(self):
+        """
+        Returns the last magnetisation OMF file saved by the MinDriver, or
+        None if there is no output
+        """
+        if self.basename is None:
+            return None
+        omfs = sorted(glob.glob('{}-Oxs_MinDriver-Magnetization-*.omf'.format(
+                                glob.escape(self.basename))))
+        return omfs[-1] if omfs else None
+
+    def final_odt_values(self, columns):
+        """
+        Returns a dictionary with the values of the columns in the last row
+        of the ODT file of the run. Values that cannot be read are None
+        """
+        values = dict.fromkeys(columns)
+        if self.basename is None:
+            return values
+        try:
+            odt_file = '{}.odt'.format(self.basename)
+            odt = ot.OOMMFODTRead(odt_file, columns=[])
+            row = ot.last_odt_row(odt_file)
+        except Exception:
+            return values
+
+        for column in columns:
+            if column in odt.columns and odt.columns[column] < len(row):
+                values[column] = float(row[odt.columns[column]])
+        return values
+
+    def iterations(self):
+        """
+        Returns the number of iterations of the MinDriver from the ODT file
+        of the run, or None if it cannot be read
+        """
+        iterations = self.final_odt_values([ITERATION_COLUMN])[
+            ITERATION_COLUMN]
+        return None if iterations is None else int(iterations)
+
+    def statistics(self):
+        """
+        Returns a dictionary with the MinDriver iterations, the final
+        maximum of |m x H x m| (A/m) and total energy (J) of the run, from
+        the ODT file, and the number and total size (bytes) of its output
+        files
+        """
+        values = self.final_odt_values([ITERATION_COLUMN, MXHXM_COLUMN,
+                                        ENERGY_COLUMN])
+        iterations = values[ITERATION_COLUMN]
+        outputs = self.outputs()
+
+        return {'iterations': None if iterations is None else int(iterations),
+                'max_mxHxm': values[MXHXM_COLUMN],
+                'energy': values[ENERGY_COLUMN],
+                'n_outputs': len(outputs),
+                'output_bytes': sum(os.path.getsize(f) for f in outputs),
+                }
+
+    def outputs(self):
+        """
+        Returns the list of output files (ODT and OMF) of the run
+        """
+        if self.basename is None:
+            return []
+        return (glob.glob('{}.odt'.format(glob.escape(self.basename))) +
+                glob.glob('{}-Oxs_*.o[hm]f'.format(
+                          glob.escape(self.basename))))
+
+    def cache_key(self, oommf_version=''):
+        """
+        Returns a hash of the MIF file content, the -parameters string, the
+        content of the input files in the parameters (e.g. the initial
+        state OMF file) and the OOMMF version, identifying the results of
+        this run
+        """
+        sha = hashlib.sha256()
+        with open(self.mif_file, 'rb') as f:
+            sha.update(f.read())
+        sha.update(self.parameters_string().encode())
+        for k, v in sorted(self.parameters.items()):
+            if k != 'BASENAME' and os.path.isfile(str(v)):
+                with open(str(v), 'rb') as f:
+                    for block in iter(lambda: f.read(2 ** 20), b''):
+                        sha.update(block)
+        sha.update(oommf_version.encode())
+        return sha.hexdigest()
+
+    @property
+    def cache_file(self):
+        if self.basename is None:
+            return None
+        return '{}.cache.json'.format(self.basename)
+
+    def is_cached(self, key):
+        """
+        True if the run with this cache key has finished before and its
+        final OMF and ODT files exist and are valid
+        """
+        if self.cache_file is None or not os.path.exists(self.cache_file):
+            return False
+
+        try:
+            with open(self.cache_file) as f:
+                cache = json.load(f)
+        except ValueError:
+            return False
+
+        if cache.get('key') != key:
+            return False
+
+        omf = self.final_omf()
+        if omf is None or os.path.basename(omf) != cache.get('omf'):
+            return False
+
+        return valid_omf(omf) and self.iterations() is not None
+
+    def finished_odt(self):
+        """
+        True if the ODT file of the run is complete, i.e. OOMMF closed its
+        table with the '# Table End' line
+        """
+        odt_file = '{}.odt'.format(self.basename)
+        try:
+            with open(odt_file, 'rb') as f:
+                f.seek(max(0, os.path.getsize(odt_file) - 64))
+                return b'# Table End' in f.read()
+        except OSError:
+            return False
+
+    def reuse_outputs(self, key):
+        """
+        True if the results of the run can be reused: they are cached with
+        this key (see is_cached), or they were saved before the cache
+        existed (there is no cache file) and the final OMF file and the ODT
+        file are complete, in which case the cache file is written
+        """
+        if self.is_cached(key):
+            return True
+
+        if (self.cache_file is None or os.path.exists(self.cache_file)
+                or self.final_omf() is None):
+            return False
+
+        if (valid_omf(self.final_omf()) and self.finished_odt()
+                and self.iterations() is not None):
+            self.save_cache(key)
+            return True
+        return False
+
+    def set_aside_outputs(self):
+        """
+        Moves the outputs of the run (and its cache file), e.g. of an
+        incomplete run or of a run with other parameters, to the
+        stale_outputs folder next to them, so the run starts without old
+        outputs. Files are never overwritten
+        """
+        files = self.outputs()
+        if self.cache_file is not None and os.path.exists(self.cache_file):
+            files.append(self.cache_file)
+
+        for output in files:
+            folder = os.path.join(os.path.dirname(output), 'stale_outputs')
+            if not os.path.exists(folder):
+                os.makedirs(folder)
+            target = os.path.join(folder, os.path.basename(output))
+            i = 1
+            while os.path.exists(target):
+                target = os.path.join(folder, '{}.{}'.format(
+                                      os.path.basename(output), i))
+                i += 1
+            os.rename(output, target)
+
+    def save_cache(self, key):
+        with open(self.cache_file, 'w') as f:
+            json.dump({'key': key,
+                       'omf': os.path.basename(self.final_omf()),
+                       'parameters': self.parameters}, f)
+
+    def resample_initial_state(self, omf_key='OMFFILE'):
+        """
+        If the initial state OMF file (the omf_key parameter) has a mesh
+        different from the geometry of the job, e.g. a state relaxed on a
+        coarser mesh, it is resampled to this mesh, saved as BASENAME.init.ovf
+        and the omf_key parameter is updated
+        """
+        omf_file = self.parameters.get(omf_key)
+        if self.geometry is None or not omf_file:
+            return
+
+        geometry = ot.OOMMFDataRead(omf_file).geometry()
+        if (geometry[:3] == tuple(self.geometry[:3]) and
+                np.allclose(geometry[3:], self.geometry[3:], rtol=1e-6,
+                            atol=1e-15)):
+            return
+
+        self.parameters[omf_key] = ot.resample_omf(
+            omf_file, self.geometry, '{}.init.ovf'.format(self.basename))
+
+    def parameters_string(self):
+        return ' '.join('{} {}'.format(k, v)
+                        for k, v in self.parameters.items())
+
+    def command(self, threads, oommf='oommf'):
+        """
+        Returns the boxsi command as a list of arguments. oommf is the
+        command to call OOMMF, e.g. 'oommf' or 'tclsh /path/to/oommf.tcl'
+        """
+        return (shlex.split(oommf) +
+                ['boxsi', '-threads', str(threads),
+                 '-parameters', self.parameters_string(),
+                 self.mif_file])
+
+
+def valid_omf(omf_file):
+    """
+    True if the OMF file has a readable header and a complete data block
+    """
+    try:
+        omf = ot.OOMMFDataRead(omf_file)
+        n_values = omf.nx * omf.ny * omf.nz * 3
+
+        if omf.data_format.startswith('binary'):
+            itemsize = omf.binary_dtype().itemsize
+            return (os.path.getsize(omf_file) >=
+                    omf.data_offset + itemsize * (n_values + 1))
+
+        # Text files end with the '# End: Segment' line
+        with open(omf_file, 'rb') as f:
+            f.seek(max(0, os.path.getsize(omf_file) - 64))
+            return b'# End: Segment' in f.read()
+
+    except Exception:
+        return False
+
+
+@functools.lru_cache()
+def oommf_version(oommf='oommf'):
+    """
+    Returns the output of the OOMMF +version command (an empty string if
+    OOMMF cannot be called)
+    """
+    try:
+        output = subprocess.run(shlex.split(oommf) + ['+version'],
+                                stdout=subprocess.PIPE,
+                                stderr=subprocess.STDOUT,
+                                timeout=60)
+        return output.stdout.decode('latin-1').strip()
+    except (OSError, subprocess.SubprocessError):
+        return ''
+
+
+def threads_per_job(n_jobs, total_cores, max_threads=8):
+    """
+    Number of threads of every OOMMF process, such that the jobs fill the
+    available cores. OOMMF threading saturates at a few threads, so it is
+    more efficient to run more processes than to use more threads
+    """
+    return max(1, min(max_threads, total_cores // max(1, n_jobs)))
+
+
+def field_continuation(jobs, key='Bz', descending=False):
+    """
+    Returns a continuation chain from a list of SweepJob objects that only
+    differ in the parameter key (e.g. the applied field of a sweep). The
+    jobs are sorted by this parameter in ascending (or descending) order and
+    every job starts from the relaxed state of the previous one, which is
+    passed in the OMF parameter of run_sweep (the MIF file must load it
+    with Oxs_FileVectorField). Run the chains with run_sweep
+    """
+    return sorted(jobs, key=lambda j: float(j.parameters[key]),
+                  reverse=descending)
+
+
+def coarse_to_fine(chain, geometry, factors=(2,),
+                   cell_keys=('CELLX', 'CELLY', 'CELLZ')):
+    """
+    Returns a continuation chain where the first job of chain (a SweepJob
+    or a list of them, e.g. from field_continuation) is preceded by the
+    relaxation of the same simulation on meshes with cells factor times
+    larger, from the coarsest. Every relaxed state is resampled to the mesh
+    of the next job (see SweepJob.resample_initial_state), so most of the
+    motion of the domain walls is computed on the cheap coarse meshes
+
+    Parameters:
+
+        chain       :: SweepJob or list of SweepJob objects
+        geometry    :: mesh geometry tuple of the jobs of chain
+        factors     :: cell size factors of the coarse stages. Directions
+                       where the number of cells is not a multiple of the
+                       factor are coarsened less (see
+                       oommf_tools.coarse_geometry)
+        cell_keys   :: MIF parameters with the cell size along x, y and z
+
+    The coarse stages are saved in the coarse folder next to BASENAME. Run
+    the chains with run_sweep
+    """
+    if isinstance(chain, SweepJob):
+        chain = [chain]
+    chain = list(chain)
+    first = chain[0]
+
+    folder, name = os.path.split(first.basename)
+    coarse_folder = os.path.join(folder, 'coarse')
+    if not os.path.exists(coarse_folder):
+        os.makedirs(coarse_folder)
+
+    stages = []
+    for factor in sorted(factors, reverse=True):
+        coarse = ot.coarse_geometry(geometry, factor)
+        # Factors can give the same mesh when the cells are not divisible
+        if stages and stages[-1].geometry == coarse:
+            continue
+        parameters = dict(first.parameters)
+        for key, d in zip(cell_keys, coarse[3:6]):
+            parameters[key] = repr(d)
+        parameters['BASENAME'] = os.path.join(
+            coarse_folder, '{}_coarse{}'.format(name, factor))
+        stages.append(SweepJob(first.mif_file, parameters, geometry=coarse))
+
+    for job in chain:
+        if job.geometry is None:
+            job.geometry = geometry
+
+    return stages + chain
+
+
+def run_sweep(jobs, total_cores=None, threads=None, max_threads=8,
+              oommf='oommf', manifest='sweep_manifest.jsonl',
+              omf_key='OMFFILE', cache=True):
+    """
+    Runs a list of SweepJob objects, with as many simultaneous boxsi
+    processes as fit in the total number of cores
+
+    Elements of jobs can also be continuation chains, i.e. lists of
+    SweepJob objects (see field_continuation), which are run one after the
+    other, passing the final OMF file of a job in the omf_key parameter of
+    the next one. If a job of the chain fails, the next one starts from the
+    initial state of the MIF file. Different chains run at the same time.
+    Initial states are resampled to the mesh of the jobs with a geometry,
+    e.g. in coarse_to_fine chains
+
+    Parameters:
+
+        jobs            :: list of SweepJob objects or lists of them
+        total_cores     :: cores available for the sweep (default: all)
+        threads         :: threads of every OOMMF process. By default they
+                           are chosen with threads_per_job
+        max_threads     :: maximum number of threads per process
+        oommf           :: command to call OOMMF
+        manifest        :: JSON lines file where a record is appended for
+                           every finished job, with its parameters, exit
+                           status, wall time, MinDriver iterations and the
+                           other values of SweepJob.statistics
+        omf_key         :: MIF parameter with the initial state OMF file in
+                           continuation chains
+        cache           :: skip the runs that finished before with the same
+                           MIF file, parameters and OOMMF version (see
+                           SweepJob.cache_key) and whose outputs are valid.
+                           Complete outputs saved before the cache existed
+                           are reused (see SweepJob.reuse_outputs). Outputs
+                           of incomplete or different runs are moved to a
+                           stale_outputs folder before running them again
+
+    Returns the list of records of the finished jobs
+    """
+    if total_cores is None:
+        total_cores = os.cpu_count()
+    if threads is None:
+        threads = threads_per_job(len(jobs), total_cores, max_threads)
+    n_processes = max(1, total_cores // threads)
+
+    lock = threading.Lock()
+
+    version = oommf_version(oommf) if cache else ''
+
+    def run(job, warm_start=False):
+        command = job.command(threads, oommf)
+        key = job.cache_key(version) if cache else None
+        cached = cache and job.reuse_outputs(key)
+
+        start = time.time()
+        if cached:
+            returncode = 0
+        else:
+            if cache:
+                job.set_aside_outputs()
+
+            if job.log_file is not None:
+                with open(job.log_file, 'w') as log:
+                    returncode = subprocess.call(command, stdout=log,
+                                                 stderr=subprocess.STDOUT)
+            else:
+                returncode = subprocess.call(command)
+
+            if (cache and returncode == 0 and job.final_omf() is not None
+                    and job.cache_file is not None):
+                job.save_cache(key)
+
+        record = {'mif_file': job.mif_file,
+                  'parameters': job.parameters,
+                  'threads': threads,
+                  'command': ' '.join(shlex.quote(c) for c in command),
+                  'returncode': returncode,
+                  'start_time': start,
+                  'wall_time': time.time() - start,
+                  'log_file': job.log_file,
+                  'warm_start': warm_start,
+                  'cached': cached,
+                  'cache_key': key,
+                  }
+        # Iterations, final max mxHxm and energy, and output sizes
+        record.update(job.statistics())
+
+        if manifest is not None:
+            with lock:
+                with open(manifest, 'a') as f:
+                    f.write(json.dumps(record) + '\n')
+
+        return record
+
+    def run_chain(chain):
+        if isinstance(chain, SweepJob):
+            chain.resample_initial_state(omf_key)
+            return [run(chain)]
+
+        records = []
+        previous_omf = None
+        for job in chain:
+            if previous_omf is not None:
+                job.parameters[omf_key] = previous_omf
+            job.resample_initial_state(omf_key)
+            records.append(run(job, warm_start=previous_omf is not None))
+
+            if records[-1]['returncode'] == 0:
+                previous_omf = job.final_omf()
+            else:
+                previous_omf = None
+        return records
+
+    print('Running {} jobs: {} processes with {} threads'.format(
+          len(jobs), min(n_processes, len(jobs)), threads))
+
+    with ThreadPoolExecutor(max_workers=n_processes) as executor:
+        records = [r for chain_records in executor.map(run_chain, jobs)
+                   for r in chain_records]
+
+    return records
+
+
+def classify_job(job):
+    """
+    Returns the class of the final state of a job (see
+    oommf_analysis.classify_omf), or None if there is no output
+    """
+    omf_file = job.final_omf()
+    if omf_file is None:
+        return None
+    return oa.classify_omf(omf_file)['class']
+
+
+def refinement_points(points, classes, energies=None, resolution=None,
+                      energy_tol=None):
+    """
+    Returns the new points of an adaptive sweep: the midpoints between
+    neighbouring points (see parameter_neighbours) with different classes,
+    or with relative energy differences larger than energy_tol, which are
+    separated by more than the resolution of their parameter
+
+    Parameters:
+
+        points      :: list of dictionaries with the parameter values
+        classes     :: list with the class of every point (None for failed
+                       runs, which are not refined)
+        energies    :: list with the energy of every point (or None)
+        resolution  :: dictionary with the minimum spacing of every
+                       parameter. Midpoints are rounded to multiples of it
+        energy_tol  :: relative energy difference to refine (None to only
+                       use the classes)
+    """
+    keys = list(points[0].keys())
+    resolution = resolution or {}
+    neighbours = parameter_neighbours([{'parameters': p} for p in points],
+                                      keys)
+
+    existing = set(tuple(p[k] for k in keys) for p in points)
+    new_points = []
+    for a, a_neighbours in enumerate(neighbours):
+        for b in a_neighbours:
+            if b <= a or classes[a] is None or classes[b] is None:
+                continue
+
+            differ = classes[a] != classes[b]
+            if (not differ and energy_tol is not None and energies is not None
+                    and energies[a] is not None and energies[b] is not None):
+                scale = 0.5 * (abs(energies[a]) + abs(energies[b]))
+                differ = (scale > 0 and
+                          abs(energies[a] - energies[b]) > energy_tol * scale)
+            if not differ:
+                continue
+
+            key = [k for k in keys if points[a][k] != points[b][k]][0]
+            va, vb = sorted([points[a][key], points[b][key]])
+            step = resolution.get(key)
+            mid = 0.5 * (va + vb)
+            if step:
+                mid = round(round(mid / step) * step, 12)
+            if not va < mid < vb:
+                continue
+
+            point = dict(points[a])
+            point[key] = mid
+            if tuple(point[k] for k in keys) not in existing:
+                existing.add(tuple(point[k] for k in keys))
+                new_points.append(point)
+
+    return new_points
+
+
+def adaptive_sweep(make_job, axes, max_rounds=3, resolution=None,
+                   classify=classify_job, energy_tol=None, **run_kwargs):
+    """
+    Runs an adaptive parameter sweep: it starts with the grid of the axes
+    values and, after every round of simulations, the relaxed states are
+    classified (e.g. uniform, bubble lattice, isolated bubble, stripes) and
+    new simulations are run only at the midpoints between neighbouring
+    points with different classes (see refinement_points). Thus the phase
+    boundaries are resolved without running the full fine grid
+
+    Parameters:
+
+        make_job        :: function that returns the SweepJob of a point
+                           (dictionary with the parameter values)
+        axes            :: dictionary with the initial values of every
+                           parameter, e.g. {'Ms': [0.4, 0.5, 0.6], ...}
+        max_rounds      :: maximum number of refinement rounds
+        resolution      :: dictionary with the minimum spacing of the
+                           parameters (default: the initial spacing divided
+                           by 2 ** max_rounds). Axes with a single value
+                           are not refined
+        classify        :: function returning the class of a finished
+                           SweepJob (default: classify_job)
+        energy_tol      :: also refine between points with relative energy
+                           differences larger than this
+        run_kwargs      :: options for run_sweep, e.g. total_cores
+
+    Returns a list of dictionaries with the point, class, energy and run
+    record of every simulation
+    """
+    if resolution is None:
+        resolution = {k: (max(v) - min(v)) / (len(v) - 1) / 2 ** max_rounds
+                      for k, v in axes.items() if len(set(v)) > 1}
+
+    results = []
+    points = parameter_grid(**axes)
+    for round_index in range(max_rounds + 1):
+        if not points:
+            break
+        print('Adaptive sweep, round {}: {} points'.format(round_index,
+                                                         len(points)))
+        jobs = [make_job(p) for p in points]
+        records = run_sweep(jobs, **run_kwargs)
+
+        for point, job, record in zip(points, jobs, records):
+            results.append({'point': point,
+                            'class': (classify(job)
+                                      if record['returncode'] == 0 else None),
+                            'energy': record.get('energy'),
+                            'record': record})
+
+        if round_index == max_rounds:
+            break
+        points = refinement_points([r['point'] for r in results],
+                                   [r['class'] for r in results],
+                                   [r['energy'] for r in results],
+                                   resolution, energy_tol)
+
+    n_grid = 1
+    for k, v in axes.items():
+        if resolution.get(k, 0) > 0:
+            n_grid *= int(round((max(v) - min(v)) / resolution[k])) + 1
+        else:
+            n_grid *= len(set(v))
+    print('Adaptive sweep: {} simulations ({} in the full grid at the '
+          'final resolution)'.format(len(results), n_grid))
+
+    return results
+
+
+def iteration_savings(records, cold_records=None, omf_key='OMFFILE'):
+    """
+    Prints and returns a summary of the MinDriver iterations of a sweep,
+    from the records returned by run_sweep or read from a manifest
+
+    If cold_records, from the same sweep run without continuation, are
+    specified, the iterations are compared run by run, matching the
+    parameters. Otherwise warm started runs are compared against the runs
+    that started from the MIF initial state
+    """
+    def key(record):
+        return tuple(sorted((k, v) for k, v in record['parameters'].items()
+                            if k != omf_key))
+
+    records = [r for r in records if r.get('iterations') is not None]
+
+    if cold_records is not None:
+        cold = {key(r): r['iterations'] for r in cold_records
+                if r.get('iterations') is not None}
+        matched = [r for r in records if key(r) in cold]
+        summary = {'runs': len(matched),
+                   'iterations': sum(r['iterations'] for r in matched),
+                   'cold_iterations': sum(cold[key(r)] for r in matched)}
+    else:
+        warm = [r['iterations'] for r in records if r.get('warm_start')]
+        cold = [r['iterations'] for r in records if not r.get('warm_start')]
+        mean_cold = sum(cold) / len(cold) if cold else 0
+        summary = {'runs': len(records),
+                   'iterations': sum(warm) + sum(cold),
+                   # Estimate: every run starting from the initial state
+                   'cold_iterations': sum(cold) + mean_cold * len(warm)}
+
+    summary['saved_iterations'] = (summary['cold_iterations'] -
+                                   summary['iterations'])
+    if summary['cold_iterations'] > 0:
+        summary['saved_fraction'] = (summary['saved_iterations'] /
+                                     summary['cold_iterations'])
+
+    print('Runs: {runs}  Iterations: {iterations}  '
+          'Without continuation: {cold_iterations:.0f}  '
+          'Saved: {saved_iterations:.0f}'.format(**summary))
+
+    return summary
+
+
+def read_manifest(manifest='sweep_manifest.jsonl'):
+    """
+    Returns the list of records from a sweep manifest file
+    """
+    with open(manifest) as f:
+        return [json.loads(l) for l in f if l.strip()]
+
+
+def _float(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def parameter_neighbours(records, keys, group_keys=()):
+    """
+    Returns, for every record, the list of indexes of its neighbours in the
+    parameter space of keys: the records with the same values of all the
+    keys but one, which has the previous or next value of the sweep.
+    Neighbours also have the same values of the group_keys parameters, e.g.
+    the cell size, so runs of different meshes are not compared
+    """
+    values = [tuple(_float(r['parameters'].get(k)) for k in keys)
+              for r in records]
+    groups = [tuple(str(r['parameters'].get(k)) for k in group_keys)
+              for r in records]
+
+    neighbours = [set() for r in records]
+    for i, key in enumerate(keys):
+        # Lines of the sweep along this key
+        lines = {}
+        for n, v in enumerate(values):
+            if v[i] is not None:
+                lines.setdefault(groups[n] + v[:i] + v[i + 1:],
+                                 []).append(n)
+
+        for line in lines.values():
+            line.sort(key=lambda n: values[n][i])
+            for a, b in zip(line[:-1], line[1:]):
+                neighbours[a].add(b)
+                neighbours[b].add(a)
+
+    return [sorted(n) for n in neighbours]
+
+
+def performance_report(records, keys=None, factor=10.,
+                       quantities=('iterations', 'wall_time'),
+                       omf_key='OMFFILE',
+                       cell_keys=('CELLX', 'CELLY', 'CELLZ'), output=None):
+    """
+    Prints a performance summary of a sweep from the records returned by
+    run_sweep or read from a manifest, flagging the failed runs and the
+    outliers: runs where a quantity is more than factor times the median of
+    their neighbours in the parameter space (see parameter_neighbours), e.g.
+    a run taking 10x more iterations than the runs next to it in (Ms, A, Bz)
+
+    Parameters:
+
+        records         :: list of records
+        keys            :: parameters defining the sweep. By default, the
+                           numerical parameters that change between runs
+        factor          :: outlier threshold
+        quantities      :: record values that are compared. Wall times of
+                           cached runs are not compared
+        cell_keys       :: parameters with the cell size. Runs are only
+                           compared with runs of the same cell size, e.g.
+                           the coarse stages of coarse_to_fine chains with
+                           each other
+        output          :: JSON file to save the report
+
+    Returns the list of report rows (one per run), with the parameters, the
+    quantities and the list of flags of every run
+    """
+    def run_key(record):
+        return tuple(sorted((k, str(v))
+                            for k, v in record['parameters'].items()
+                            if k != omf_key))
+
+    # Latest record of every run (manifests are appended by every sweep)
+    latest = {}
+    for record in records:
+        latest[run_key(record)] = record
+    records = list(latest.values())
+
+    if keys is None:
+        keys = sorted(set(k for r in records for k, v in
+                          r['parameters'].items()
+                          if k != omf_key and k not in cell_keys
+                          and _float(v) is not None))
+        keys = [k for k in keys
+                if len(set(r['parameters'].get(k) for r in records)) > 1]
+
+    def value(record, quantity):
+        if quantity == 'wall_time' and record.get('cached'):
+            return None
+        return _float(record.get(quantity))
+
+    neighbours = parameter_neighbours(records, keys, group_keys=cell_keys)
+
+    rows = []
+    for record, record_neighbours in zip(records, neighbours):
+        row = {'parameters': {k: record['parameters'].get(k) for k in keys},
+               'basename': record['parameters'].get('BASENAME'),
+               'flags': []}
+        for quantity in quantities + ('max_mxHxm', 'output_bytes'):
+            row[quantity] = record.get(quantity)
+
+        if record.get('returncode') != 0:
+            row['flags'].append('failed (exit status {})'.format(
+                                record.get('returncode')))
+
+        for quantity in quantities:
+            v = value(record, quantity)
+            reference = [value(records[n], quantity)
+                         for n in record_neighbours]
+            reference = [r for r in reference if r is not None]
+            if v is None or not reference:
+                continue
+            median = sorted(reference)[len(reference) // 2]
+            if median > 0 and v > factor * median:
+                row['flags'].append('{} {:.4g} = {:.1f}x neighbours'.format(
+                                    quantity, v, v / median))
+
+        rows.append(row)
+
+    wall_times = [r['wall_time'] for r in records
+                  if not r.get('cached') and r.get('wall_time') is not None]
+    iterations = [r['iterations'] for r in records
+                  if r.get('iterations') is not None]
+    print('Runs: {}  Failed: {}  Cached: {}'.format(
+          len(records), sum(r.get('returncode') != 0 for r in records),
+          sum(bool(r.get('cached')) for r in records)))
+    print('Wall time: {:.1f} s  Iterations: {}  Output: {:.1f} MB'.format(
+          sum(wall_times), sum(iterations),
+          sum(r.get('output_bytes') or 0 for r in records) / 1e6))
+    if wall_times:
+        slowest = max(records, key=lambda r: (not r.get('cached'),
+                                              r.get('wall_time') or 0))
+        print('Slowest run: {:.1f} s {}'.format(
+              slowest['wall_time'],
+              {k: slowest['parameters'].get(k) for k in keys}))
+
+    flagged = [r for r in rows if r['flags']]
+    if flagged:
+        print('Flagged runs (above {:g} times the median of the '
+              'neighbours in {}):'.format(factor, ', '.join(keys)))
+        for r in flagged:
+            print('  {}: {}'.format(r['parameters'], '; '.join(r['flags'])))
+
+    if output is not None:
+        with open(output, 'w') as f:
+            json.dump({'keys': keys, 'factor': factor, 'runs': rows},
+                      f, indent=1)
+
+    return rows
@@ -1,46 +1,368 @@
 import numpy as np
 import re
-import colorsys
+import os
+import glob
+import functools
+import itertools
+import zipfile
+import tempfile
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
 
 
 # -----------------------------------------------------------------------------
 # Utilities to generate a HSL colourmap from the magnetisation field data
 
-def convert_to_RGB(hls_color):
-    return np.array(colorsys.hls_to_rgb(hls_color[0] / (2 * np.pi),
-                                        hls_color[1],
-                                        hls_color[2]))
+def colour_workspace(workspace, name, shape, dtype):
+    """
+    Returns the array name of the workspace dictionary, allocating it if it
+    is missing or has a different shape or dtype. Temporary arrays of the
+    colour functions are kept in a workspace to reuse them between calls
+    (a new dictionary is used when workspace is None)
+    """
+    array = workspace.get(name)
+    if array is None or array.shape != shape or array.dtype != dtype:
+        array = workspace[name] = np.empty(shape, dtype=dtype)
+    return array
 
 
-def generate_colours(field_data, colour_model='rgb'):
+def hls_to_rgb(hls, out=None, workspace=None):
+    """
+    Vectorised version of colorsys.hls_to_rgb with the hue in radians
+
+    hls         ::  (..., 3) array with the hue (in [0, 2 pi)), lightness
+                    and saturation
+    out         ::  optional (..., 3) array where the RGB values are
+                    written (it can be hls)
+    workspace   ::  optional dictionary with the temporary arrays, to
+                    reuse them in repeated calls (see colour_workspace)
     """
-    field_data      ::  (n, 3) array
+    if out is None:
+        out = np.empty_like(hls)
+    if workspace is None:
+        workspace = {}
+
+    shape, dtype = hls.shape[:-1], hls.dtype
+    h, m1, m2, hue, f = [colour_workspace(workspace, name, shape, dtype)
+                         for name in ['h', 'm1', 'm2', 'hue', 'f']]
+    small_l = colour_workspace(workspace, 'mask', shape, bool)
+
+    np.multiply(hls[..., 0], 1 / (2 * np.pi), out=h)
+    l, s = hls[..., 1], hls[..., 2]
+
+    # m2 = l (1 + s) for l <= 0.5 and l + s - l s above
+    np.multiply(l, s, out=m1)
+    np.add(l, s, out=m2)
+    m2 -= m1
+    np.add(l, m1, out=hue)
+    np.less_equal(l, 0.5, out=small_l)
+    np.copyto(m2, hue, where=small_l)
+    # m1 = 2 l - m2
+    np.multiply(l, 2, out=m1)
+    m1 -= m2
+    m2 -= m1
+
+    # Every channel is m1 + (m2 - m1) * f(hue) with f a trapezoid of
+    # height 1 in [1/6, 1/2] and zero above 2/3 (hue in [0, 1))
+    for i, shift in enumerate([1. / 3, 0., -1. / 3]):
+        np.add(h, shift, out=hue)
+        np.mod(hue, 1., out=hue)
+        hue *= 6
+        np.subtract(4, hue, out=f)
+        np.minimum(hue, f, out=f)
+        np.clip(f, 0, 1, out=f)
+        f *= m2
+        np.add(m1, f, out=out[..., i])
+
+    return out
+
+
+def generate_colours(field_data, colour_model='rgb', out=None,
+                     workspace=None):
+    """
+    field_data      ::  (n, 3) or (ny, nx, 3) array
+    colour_model    ::  'rgb', 'hls' or 'rgba' (uint8 values for imshow or
+                        PNG images)
+    out             ::  optional preallocated output array: (..., 3) for
+                        'rgb' and 'hls' and (..., 4) of uint8 for 'rgba'
+    workspace       ::  optional dictionary with the temporary arrays (see
+                        colour_workspace). With out and the same workspace,
+                        repeated calls for arrays of the same shape do not
+                        allocate arrays
+
+    Float32 data is processed in single precision
     """
-    hls = np.ones_like(field_data)
-    hls[:, 0] = np.arctan2(field_data[:, 1],
-                           field_data[:, 0]
-                           )
-    hls[:, 0][hls[:, 0] < 0] = hls[:, 0][hls[:, 0] < 0] + 2 * np.pi
-    hls[:, 1] = 0.5 * (field_data[:, 2] + 1)
+    if colour_model not in ['rgb', 'hls', 'rgba']:
+        raise Exception('Specify a valid colour model: rgb, hls or rgba')
+    if workspace is None:
+        workspace = {}
 
-    if colour_model == 'rgb':
-        rgbs = np.apply_along_axis(convert_to_RGB, 1, hls)
-        return rgbs
+    field_data = np.asarray(field_data)
+    dtype = np.result_type(field_data.dtype, np.float32)
 
-    elif colour_model == 'hls':
+    if colour_model == 'hls':
+        hls = out if out is not None else np.empty(field_data.shape, dtype)
+    else:
+        hls = colour_workspace(workspace, 'hls', field_data.shape, dtype)
+
+    negative = colour_workspace(workspace, 'mask', field_data.shape[:-1],
+                                bool)
+    np.arctan2(field_data[..., 1], field_data[..., 0], out=hls[..., 0])
+    np.less(hls[..., 0], 0, out=negative)
+    np.add(hls[..., 0], 2 * np.pi, out=hls[..., 0], where=negative)
+    np.add(field_data[..., 2], 1, out=hls[..., 1])
+    hls[..., 1] *= 0.5
+    hls[..., 2] = 1
+
+    if colour_model == 'hls':
         return hls
 
+    elif colour_model == 'rgb':
+        return hls_to_rgb(hls, out=out, workspace=workspace)
+
     else:
-        raise Exception('Specify a valid colour model: rgb or hls')
+        rgb = hls_to_rgb(hls, out=hls, workspace=workspace)
+        rgb *= 255
+        rgb += 0.5
+        if out is None:
+            out = np.empty(field_data.shape[:-1] + (4,), dtype=np.uint8)
+        out[..., :3] = rgb
+        out[..., 3] = 255
+        return out
+
+
+# -----------------------------------------------------------------------------
+
+
+def normalise(field_data):
+    """
+    Normalises in place the vectors of a (..., 3) array. Vectors of zero
+    length are kept as zero
+    """
+    Ms = np.sqrt(np.einsum('...i,...i', field_data, field_data))
+    Ms[Ms == 0.0] = 1.0
+    field_data /= Ms[..., np.newaxis]
+    return field_data
+
+
+# -----------------------------------------------------------------------------
+# Parallel parsing of text data (OMF data blocks and ODT tables)
+
+
+# Text smaller than this (in bytes) is parsed in a single process
+PARALLEL_TEXT_SIZE = 2 ** 24
+COMMENT_LINE = re.compile(rb'^[ \t]*#.*$', flags=re.MULTILINE)
+# Starts of comment and blank lines, after a newline
+COMMENT_START = re.compile(rb'\n[ \t]*#')
+BLANK_LINE = re.compile(rb'\n[ \t\r]*(?=\n|\Z)')
+
+# Processes parsing text chunks, started when they are first needed and
+# reused by the next calls of parse_text (see text_pool)
+_TEXT_POOL = None
+_TEXT_POOL_WORKERS = 0
+_TEXT_POOL_LOCK = threading.Lock()
+
+
+def text_pool(workers):
+    """
+    Returns the pool of processes of parse_text, with at least workers
+    processes. The pool is kept in this module and reused, and its
+    processes are started with the spawn method, thus they are not forked
+    from a process with running threads (e.g. the threads of
+    oommf_sweep.run_sweep)
+    """
+    global _TEXT_POOL, _TEXT_POOL_WORKERS
+
+    with _TEXT_POOL_LOCK:
+        if _TEXT_POOL is None or _TEXT_POOL_WORKERS < workers:
+            if _TEXT_POOL is not None:
+                _TEXT_POOL.shutdown()
+            _TEXT_POOL = ProcessPoolExecutor(
+                max_workers=workers,
+                mp_context=multiprocessing.get_context('spawn'))
+            _TEXT_POOL_WORKERS = workers
+        return _TEXT_POOL
+
+
+def newline_offsets(input_file, start, end, n_chunks):
+    """
+    Splits the byte range [start, end) of a file into n_chunks ranges (or
+    fewer) starting at the beginning of a line. Returns the array with the
+    n + 1 offsets of the ranges
+    """
+    offsets = [start]
+    with open(input_file, 'rb') as f:
+        for target in np.linspace(start, end, n_chunks + 1)[1:-1]:
+            target = max(int(target), offsets[-1])
+            f.seek(target)
+            # The chunk ends after the first newline from the target
+            line = f.readline()
+            offset = min(end, target + len(line))
+            if offset > offsets[-1]:
+                offsets.append(offset)
+    if end > offsets[-1]:
+        offsets.append(end)
+    return np.array(offsets)
+
+
+def count_text_rows(input_file, start, end):
+    """
+    Returns the number of lines with data in the byte range [start, end)
+    of a file, i.e. the lines which are not comment or blank lines
+    """
+    with open(input_file, 'rb') as f:
+        f.seek(start)
+        # Every line starts after a newline
+        data = b'\n' + f.read(end - start)
+    return (data.count(b'\n') - len(COMMENT_START.findall(data)) -
+            len(BLANK_LINE.findall(data)))
+
+
+def parse_text_chunk(input_file, start, end, n_columns, usecols=None,
+                     dtype=np.float64):
+    """
+    Returns the numbers of the lines in the byte range [start, end) of a
+    file as an (n_rows, n_columns) array (only the usecols columns, if
+    specified). Comment lines, starting with #, are skipped
+    """
+    with open(input_file, 'rb') as f:
+        f.seek(start)
+        data = f.read(end - start)
+    if b'#' in data:
+        data = COMMENT_LINE.sub(b'', data)
+
+    values = np.fromstring(data.decode('latin-1'), dtype=dtype, sep=' ')
+    if values.size % n_columns:
+        raise Exception('Invalid number of values in {} (bytes {} to '
+                        '{})'.format(input_file, start, end))
+    values = values.reshape(-1, n_columns)
+    if usecols is not None:
+        values = values[:, usecols]
+    return values
+
+
+def write_text_chunk(output_file, shape, row, input_file, start, end,
+                     n_columns, usecols=None, dtype=np.float64):
+    """
+    Parses the byte range [start, end) of a file (see parse_text_chunk) and
+    writes the numbers into the rows of the output array from row. The
+    output array, with the given shape, is memory mapped from output_file
+    """
+    values = parse_text_chunk(input_file, start, end, n_columns, usecols,
+                              dtype)
+    if row + len(values) > shape[0]:
+        raise Exception('More than {} rows in {}'.format(shape[0],
+                                                        input_file))
+    output = np.memmap(output_file, dtype=dtype, mode='r+', shape=shape)
+    output[row:row + len(values)] = values
+    output.flush()
+    return len(values)
+
+
+def parse_text(input_file, n_columns, start=0, end=None, usecols=None,
+               dtype=np.float64, n_rows=None, workers=1):
+    """
+    Parses the text numbers of a file, with n_columns numbers per line,
+    optionally using several processes: the byte range [start, end) with the data (by
+    default the whole file) is split at line boundaries (see
+    newline_offsets), the rows of every chunk are counted and the chunks
+    are parsed at the same time, straight into the rows of a memory mapped
+    output array (see write_text_chunk). Comment lines are skipped, and the
+    lines out of the range must be comment lines, e.g. the header of an OMF
+    file, since small files are read with np.loadtxt in this process
+
+    Parallel parsing is opt-in. The processes are started with the spawn
+    method (see text_pool), which imports the __main__ module again in
+    every process, thus scripts parsing large files with several workers
+    must run their code under an if __name__ == '__main__': block
+
+    Parameters:
+
+        input_file      :: text file, e.g. OMF or ODT file
+        n_columns       :: numbers per line
+        start, end      :: byte range with the data
+        usecols         :: list of the indexes of the columns to keep
+        dtype           :: np.float64 or np.float32
+        n_rows          :: number of rows, if known, which is checked
+        workers         :: number of processes (None for all the cores).
+                           Ranges smaller than PARALLEL_TEXT_SIZE are
+                           parsed in this process
+
+    Returns the (n_rows, n_columns) array (or n_rows x len(usecols))
+    """
+    if end is None:
+        end = os.path.getsize(input_file)
+    if workers is None:
+        workers = os.cpu_count()
+    n_chunks = int(min(workers, max(1, (end - start) // 2 ** 20)))
+
+    n_out = n_columns if usecols is None else len(usecols)
+    args = (n_columns, usecols, dtype)
+
+    if n_chunks < 2 or end - start < PARALLEL_TEXT_SIZE:
+        data = np.loadtxt(input_file, dtype=dtype, usecols=usecols, ndmin=2)
+        if n_rows is not None and len(data) != n_rows:
+            raise Exception('Expected {} rows in {}, found {}'.format(
+                            n_rows, input_file, len(data)))
+        return data
+
+    offsets = newline_offsets(input_file, start, end, n_chunks)
+    chunks = list(zip(offsets[:-1], offsets[1:]))
+    executor = text_pool(n_chunks)
+
+    # First row of every chunk in the output array
+    futures = [executor.submit(count_text_rows, input_file, a, b)
+               for a, b in chunks]
+    counts = [future.result() for future in futures]
+    rows = np.concatenate([[0], np.cumsum(counts)])
+    if n_rows is not None and rows[-1] != n_rows:
+        raise Exception('Expected {} rows in {}, found {}'.format(
+                        n_rows, input_file, rows[-1]))
+    shape = (int(rows[-1]), n_out)
+    if shape[0] == 0:
+        return np.empty(shape, dtype=dtype)
+
+    fd, output_file = tempfile.mkstemp(suffix='.dat')
+    try:
+        os.ftruncate(fd, shape[0] * n_out * np.dtype(dtype).itemsize)
+        os.close(fd)
+        futures = [executor.submit(write_text_chunk, output_file, shape,
+                                   int(row), input_file, a, b, *args)
+                   for row, (a, b) in zip(rows, chunks)]
+        for count, future in zip(counts, futures):
+            if future.result() != count:
+                raise Exception('Invalid number of rows in {}'.format(
+                                input_file))
+
+        # The file is removed while it is mapped: its space is freed when
+        # the array is deleted
+        data = np.memmap(output_file, dtype=dtype, mode='r+', shape=shape)
+    finally:
+        os.remove(output_file)
+
+    return data.view(np.ndarray)
 
 
 # -----------------------------------------------------------------------------
 
 
+# Bytes read at a time when searching the layers of a text data block
+TEXT_SCAN_BLOCK = 2 ** 20
+
+# Control values written at the start of an OOMMF binary data block, used to
+# check the precision and the byte order of the numbers
+BINARY_CONTROL = {4: 1234567.0, 8: 123456789012345.0}
+
+
 class OOMMFDataRead(object):
     """
     Class to extract the magnetisation field data from an OOMMF file with
     a regular mesh grid (coordinates are generated in this class)
+
+    Data blocks can be written as text or as OOMMF binary data with 4 or 8
+    bytes per number (OVF 1.0 files are big-endian and OVF 2.0 files are
+    little-endian, the byte order is found from the control value)
     """
 
     def __init__(self, input_file):
@@ -50,15 +372,36 @@ class OOMMFDataRead(object):
 
     def read_header(self):
 
-        _file = open(self.input_file)
+        _file = open(self.input_file, 'rb')
+
+        if _file.read(4) == ARCHIVE_MAGIC:
+            # Compressed archive (see omf_to_archive), with the OMF header
+            # stored as text
+            _file.close()
+            with zipfile.ZipFile(self.input_file) as archive:
+                data = archive.read(ARCHIVE_HEADER).decode('latin-1')
+            self.data_format = 'archive'
+            self.data_offset = None
+        else:
+            _file.seek(0)
 
-        # Generate a single string with the whole header up to the line where
-        # numerical Data starts
-        line = _file.readline()
-        data = ''
-        while not line.startswith('# Begin: Data Text'):
-            data += line
+            # Generate a single string with the whole header up to the line
+            # where numerical Data starts
             line = _file.readline()
+            data = ''
+            while not line.startswith(b'# Begin: Data'):
+                if not line:
+                    _file.close()
+                    raise Exception('No data block found in {}'.format(
+                                    self.input_file))
+                data += line.decode('latin-1')
+                line = _file.readline()
+
+            # Data format: 'text', 'binary 4' or 'binary 8', and the position
+            # in bytes where the data block starts
+            self.data_format = line[13:].decode('latin-1').strip().lower()
+            self.data_offset = _file.tell()
+        self.header_text = data
 
         attrs = {'xstepsize': 'dx',  'ystepsize': 'dy', 'zstepsize': 'dz',
                  'xbase': 'xbase',  'ybase': 'ybase', 'zbase': 'zbase',
@@ -66,55 +409,1064 @@ class OOMMFDataRead(object):
                  'xmax': 'xmax', 'ymax': 'ymax', 'zmax': 'zmax',
                  }
 
-        # Regex search the attributes. Stepsizes are specified as dx, dy, dz
+        # Parse every "# key: value" line of the header in a single pass.
+        # Stepsizes are specified as dx, dy, dz
+        self.header = dict(re.findall(r'^#\s*([\w ]+?):[ \t]*(.*?)\s*$',
+                                      data, flags=re.MULTILINE))
         for k in attrs.keys():
-            num_val = float(re.search('(?<={}: )[0-9\-\.e]+'.format(k),
-                            data).group(0))
-            setattr(self, attrs[k], num_val)
+            setattr(self, attrs[k], float(self.header[k]))
 
         # Compute number of elements in each direction
-        self.nx = int((self.xmax - self.xmin) / self.dx)
-        self.ny = int((self.ymax - self.ymin) / self.dy)
-        self.nz = int((self.zmax - self.zmin) / self.dz)
+        self.nx = int(round((self.xmax - self.xmin) / self.dx))
+        self.ny = int(round((self.ymax - self.ymin) / self.dy))
+        self.nz = int(round((self.zmax - self.zmin) / self.dz))
+
+        # Axis vectors with the coordinates of the cell centres in nm
+        self.xs = (self.xbase + np.arange(self.nx) * self.dx) * 1e9
+        self.ys = (self.ybase + np.arange(self.ny) * self.dy) * 1e9
+        self.zs = (self.zbase + np.arange(self.nz) * self.dz) * 1e9
 
         _file.close()
 
-    def read_m(self):
-        data = np.loadtxt(self.input_file)
-        Ms = np.sqrt(np.sum(data ** 2, axis=1))
-        Ms[Ms == 0.0] = 0.0
-        self.mx, self.my, self.mz = (data[:, 0] / Ms,
-                                     data[:, 1] / Ms,
-                                     data[:, 2] / Ms)
+    def binary_dtype(self):
+        """
+        Returns the numpy dtype of a binary data block, checking the
+        control value at the beginning of the block for both byte orders
+        """
+        nbytes = int(self.data_format.split()[-1])
+        if nbytes not in BINARY_CONTROL:
+            raise Exception('Invalid data format: {}'.format(self.data_format))
+
+        with open(self.input_file, 'rb') as _file:
+            _file.seek(self.data_offset)
+            control = _file.read(nbytes)
+
+        for endian in ['<', '>']:
+            dtype = np.dtype('{}f{}'.format(endian, nbytes))
+            if np.frombuffer(control, dtype=dtype)[0] == BINARY_CONTROL[nbytes]:
+                return dtype
+
+        raise Exception('Invalid binary control value in {}'.format(
+                        self.input_file))
+
+    def text_data_end(self, block_size=65536):
+        """
+        Returns the byte offset where a text data block ends, i.e. the
+        start of the '# End: Data Text' line
+        """
+        with open(self.input_file, 'rb') as _file:
+            _file.seek(0, os.SEEK_END)
+            size = _file.tell()
+            position = max(self.data_offset, size - block_size)
+            _file.seek(position)
+            end = _file.read().rfind(b'# End: Data')
+
+        if end < 0:
+            raise Exception('No end of the data block found in {}'.format(
+                            self.input_file))
+        return position + end
+
+    def read_data(self, workers=1):
+        """
+        Returns the raw field data as a (n, 3) array. Binary files are
+        memory mapped instead of parsed, and text data blocks are parsed
+        with workers processes (see parse_text)
+        """
+        if self.data_format == 'text':
+            return parse_text(self.input_file, 3, start=self.data_offset,
+                              end=self.text_data_end(),
+                              n_rows=self.nx * self.ny * self.nz,
+                              workers=workers)
+
+        elif self.data_format.startswith('binary'):
+            dtype = self.binary_dtype()
+            return np.memmap(self.input_file, dtype=dtype, mode='r',
+                             offset=self.data_offset + dtype.itemsize,
+                             shape=(self.nx * self.ny * self.nz, 3))
+
+        elif self.data_format == 'archive':
+            data = np.empty((self.nz, self.ny, self.nx, 3))
+            for k in range(self.nz):
+                data[k] = self.read_layer_data(k)
+            return data.reshape(-1, 3)
+
+        else:
+            raise Exception('Invalid data format: {}'.format(self.data_format))
+
+    def read_m(self, workers=1):
+        """
+        Reads the normalised magnetisation into the self.m array with shape
+        (nz, ny, nx, 3), i.e. self.m[k, j, i] is the magnetisation at
+        (self.xs[i], self.ys[j], self.zs[k]). Layers and line profiles are
+        slices of this array, e.g. self.m[k, self.ny // 2, :, 2]
+
+        The self.mx, self.my and self.mz arrays, with the data in the order
+        of the OMF file, are views of self.m. Text files are parsed with
+        workers processes (see parse_text, a single process by default)
+        """
+        data = self.read_data(workers)
+        # Copy binary data (memory mapped read-only) to normalise it in
+        # place. Parsed text data is normalised in place
+        self.m = normalise(np.require(data, dtype=np.float64,
+                                      requirements=['C', 'W']
+                                      ).reshape(self.nz, self.ny, self.nx, 3))
+
+        m_flat = self.m.reshape(-1, 3)
+        self.mx, self.my, self.mz = (m_flat[:, 0],
+                                     m_flat[:, 1],
+                                     m_flat[:, 2])
+
+    def layer_text_offsets(self, k):
+        """
+        Returns the byte offsets where the z-layer k of a text data block
+        starts and ends. The data block is scanned in blocks of
+        TEXT_SCAN_BLOCK bytes, only up to the end of layer k, and the
+        layer starts found are kept for the next calls
+        """
+        scan = getattr(self, '_layer_scan', None)
+        if scan is None or scan['file'] != self.input_file:
+            # Layer starts found, and position and lines of the scan
+            scan = self._layer_scan = {'file': self.input_file,
+                                       'starts': [self.data_offset],
+                                       'position': self.data_offset,
+                                       'lines': 0}
+
+        n_layer = self.nx * self.ny
+        with open(self.input_file, 'rb') as _file:
+            while len(scan['starts']) < k + 2:
+                _file.seek(scan['position'])
+                block = _file.read(TEXT_SCAN_BLOCK)
+                if not block:
+                    raise Exception('Incomplete data block in {}'.format(
+                                    self.input_file))
+
+                newlines = np.flatnonzero(
+                    np.frombuffer(block, dtype=np.uint8) == ord('\n'))
+                # Newlines ending the last line of a layer
+                lines = scan['lines'] + np.arange(1, len(newlines) + 1)
+                ends = newlines[lines % n_layer == 0]
+                scan['starts'] += list(scan['position'] + ends + 1)
+
+                scan['lines'] += len(newlines)
+                scan['position'] += len(block)
+
+        return scan['starts'][k], scan['starts'][k + 1]
+
+    def read_layer_data(self, k):
+        """
+        Returns the raw field data of the z-layer with index k as a
+        (ny, nx, 3) array. Only this layer is read from disk
+        """
+        if k < 0:
+            k += self.nz
+        if not 0 <= k < self.nz:
+            raise Exception('Invalid layer index: {}'.format(k))
+
+        if self.data_format == 'text':
+            start, end = self.layer_text_offsets(k)
+            with open(self.input_file, 'rb') as _file:
+                _file.seek(start)
+                data = _file.read(end - start)
+            data = np.fromstring(data.decode('latin-1'), sep=' ')
+
+        elif self.data_format.startswith('binary'):
+            dtype = self.binary_dtype()
+            n_layer = self.nx * self.ny * 3
+            data = np.memmap(self.input_file, dtype=dtype, mode='r',
+                             offset=(self.data_offset + dtype.itemsize
+                                     + k * n_layer * dtype.itemsize),
+                             shape=(n_layer,))
+
+        elif self.data_format == 'archive':
+            with zipfile.ZipFile(self.input_file) as archive:
+                with archive.open(ARCHIVE_LAYER.format(k)) as layer:
+                    data = np.lib.format.read_array(layer)
+
+        else:
+            raise Exception('Invalid data format: {}'.format(self.data_format))
+
+        return data.reshape(self.ny, self.nx, 3)
+
+    def read_layer(self, k):
+        """
+        Returns the normalised magnetisation of the z-layer with index k as
+        a (ny, nx, 3) array
+        """
+        return normalise(np.array(self.read_layer_data(k), dtype=np.float64))
+
+    def __getitem__(self, k):
+        """
+        Returns the normalised magnetisation of the z-layer k when calling
+        an element of this Class through []
+        """
+        return self.read_layer(k)
+
+    def geometry(self):
+        """
+        Returns a tuple with the mesh parameters:
+            (nx, ny, nz, dx, dy, dz, xbase, ybase, zbase)
+        """
+        return (self.nx, self.ny, self.nz,
+                self.dx, self.dy, self.dz,
+                self.xbase, self.ybase, self.zbase)
+
+    def meshgrid(self):
+        """
+        Returns the X, Y, Z coordinates in nm as arrays of shape
+        (nz, ny, nx), matching self.m. These are broadcast views of the
+        axis vectors, thus no memory is allocated for them
+        """
+        shape = (self.nz, self.ny, self.nx)
+        return (np.broadcast_to(self.xs[np.newaxis, np.newaxis, :], shape),
+                np.broadcast_to(self.ys[np.newaxis, :, np.newaxis], shape),
+                np.broadcast_to(self.zs[:, np.newaxis, np.newaxis], shape))
+
+    def set_coordinates(self):
+        # Full (n, 3) coordinates array. Prefer self.xs, self.ys, self.zs
+        # or self.meshgrid() with self.m
+        # The (read-only) coordinates array is shared by all the files with
+        # the same mesh
+        self.coordinates = mesh_coordinates(self.geometry())
+        self.x, self.y, self.z = (self.coordinates[:, 0],
+                                  self.coordinates[:, 1],
+                                  self.coordinates[:, 2])
+
+
+@functools.lru_cache(maxsize=8)
+def mesh_coordinates(geometry):
+    """
+    Returns a (n, 3) array with the coordinates in nm of the mesh
+    specified by the geometry tuple from OOMMFDataRead.geometry()
+    The array is cached and cannot be modified
+    """
+    nx, ny, nz, dx, dy, dz, xbase, ybase, zbase = geometry
+
+    # The axis vectors are broadcast to the (nz, ny, nx) cells
+    coordinates = np.empty((nz, ny, nx, 3))
+    coordinates[..., 0] = (xbase + np.arange(nx) * dx) * 1e9
+    coordinates[..., 1] = ((ybase + np.arange(ny) * dy) * 1e9)[:, np.newaxis]
+    coordinates[..., 2] = ((zbase + np.arange(nz) * dz) *
+                           1e9)[:, np.newaxis, np.newaxis]
+
+    coordinates = coordinates.reshape(-1, 3)
+    coordinates.setflags(write=False)
+
+    return coordinates
+
+
+def mesh_geometry(p1, p2, cell):
+    """
+    Returns the geometry tuple (see OOMMFDataRead.geometry) of a mesh
+    between the points p1 and p2 with the specified cell size (in m)
+    """
+    pmin = np.minimum(p1, p2)
+    n = np.rint((np.maximum(p1, p2) - pmin) / cell).astype(int)
+    return (int(n[0]), int(n[1]), int(n[2]),
+            float(cell[0]), float(cell[1]), float(cell[2]),
+            float(pmin[0] + 0.5 * cell[0]),
+            float(pmin[1] + 0.5 * cell[1]),
+            float(pmin[2] + 0.5 * cell[2]))
+
+
+# -----------------------------------------------------------------------------
+# OMF writer
+
+
+OMF_HEADER = """# OOMMF OVF 2.0
+#
+# Segment count: 1
+#
+# Begin: Segment
+# Begin: Header
+#
+# Title: {title}
+# meshtype: rectangular
+# meshunit: m
+#
+# xmin: {xmin}
+# ymin: {ymin}
+# zmin: {zmin}
+# xmax: {xmax}
+# ymax: {ymax}
+# zmax: {zmax}
+#
+# valuedim: 3
+# valuelabels: m_x m_y m_z
+# valueunits: {units} {units} {units}
+#
+# xbase: {xbase}
+# ybase: {ybase}
+# zbase: {zbase}
+# xnodes: {nx}
+# ynodes: {ny}
+# znodes: {nz}
+# xstepsize: {dx}
+# ystepsize: {dy}
+# zstepsize: {dz}
+#
+# End: Header
+#
+# Begin: Data {data_format}
+"""
+
+
+TEXT_ROW_FORMAT = '%#.15g %#.15g %#.15g\n'
+TEXT_CHUNK_ROWS = 65536
+
+
+def write_omf(filename, field_data, geometry, data_format='binary 8',
+              title='m', units='A/m'):
+    """
+    Writes a vector field into an OMF file (OVF 2.0) that can be read by
+    OOMMF, e.g. with Oxs_FileVectorField, and OOMMFDataRead
+
+    Parameters:
+
+        filename        :: path of the OMF file
+        field_data      :: (nz, ny, nx, 3) or (n, 3) array with the data in
+                           the order of OMF files (x changes fastest)
+        geometry        :: mesh geometry tuple, see OOMMFDataRead.geometry
+                           and mesh_geometry
+        data_format     :: 'binary 8', 'binary 4' or 'text'
+        title           :: title of the field
+        units           :: units of the vector components ('' for
+                           dimensionless fields, written as {})
+    """
+    nx, ny, nz = [int(n) for n in geometry[:3]]
+    # Python floats, since the repr of numpy scalars is not a number
+    dx, dy, dz, xbase, ybase, zbase = [float(v) for v in geometry[3:]]
+    field_data = np.asarray(field_data).reshape(-1, 3)
+    if len(field_data) != nx * ny * nz:
+        raise Exception('Field data size does not match the mesh')
+
+    data_format = data_format.lower()
+    header_format = {'binary 8': 'Binary 8', 'binary 4': 'Binary 4',
+                     'text': 'Text'}
+    if data_format not in header_format:
+        raise Exception('Specify a valid data format: '
+                        'binary 8, binary 4 or text')
+
+    # Floats are written with the shortest repr that reads back exactly,
+    # and empty units as the empty Tcl list {}
+    values = {'xmin': xbase - 0.5 * dx,
+              'ymin': ybase - 0.5 * dy,
+              'zmin': zbase - 0.5 * dz,
+              'xmax': xbase + (nx - 0.5) * dx,
+              'ymax': ybase + (ny - 0.5) * dy,
+              'zmax': zbase + (nz - 0.5) * dz,
+              'xbase': xbase, 'ybase': ybase, 'zbase': zbase,
+              'dx': dx, 'dy': dy, 'dz': dz}
+    values = {k: repr(float(v)) for k, v in values.items()}
+    header = OMF_HEADER.format(title=title, units=units or '{}',
+                               nx=nx, ny=ny, nz=nz,
+                               data_format=header_format[data_format],
+                               **values)
+
+    with open(filename, 'wb') as f:
+        f.write(header.encode('latin-1'))
+
+        if data_format == 'text':
+            # Formatting a whole chunk with a single string operation is
+            # faster than np.savetxt, which formats row by row
+            for i in range(0, len(field_data), TEXT_CHUNK_ROWS):
+                chunk = field_data[i:i + TEXT_CHUNK_ROWS]
+                f.write((TEXT_ROW_FORMAT * len(chunk) %
+                         tuple(chunk.ravel().tolist())).encode('latin-1'))
+        else:
+            # OVF 2.0 binary data is little-endian
+            nbytes = int(data_format.split()[-1])
+            dtype = np.dtype('<f{}'.format(nbytes))
+            f.write(np.array([BINARY_CONTROL[nbytes]], dtype=dtype).tobytes())
+            np.ascontiguousarray(field_data, dtype=dtype).tofile(f)
+            f.write(b'\n')
+
+        f.write('# End: Data {}\n# End: Segment\n'.format(
+                header_format[data_format]).encode('latin-1'))
+
+
+# -----------------------------------------------------------------------------
+# Resampling of fields between meshes of the same sample
+
+
+def coarse_geometry(geometry, factor):
+    """
+    Returns the geometry tuple of the mesh of the same sample with cells
+    factor times larger. Along the directions where the number of cells is
+    not a multiple of factor, the cells are merged by the largest divisor of
+    the number of cells below factor (or kept), e.g. a 600 x 600 x 100 nm
+    sample with 4 nm cells (150 x 150 x 25) becomes 50 x 50 x 25 with 12 nm
+    x 12 nm x 4 nm cells for factor 4. Thus the cells are not always cubic
+    """
+    nx, ny, nz, dx, dy, dz, xbase, ybase, zbase = geometry
+    new = []
+    for n, d, base in [(nx, dx, xbase), (ny, dy, ybase), (nz, dz, zbase)]:
+        f = max(f for f in range(1, int(factor) + 1) if n % f == 0)
+        # The sample boundaries are kept. Cell sizes are rounded to remove
+        # float errors, e.g. 3 * 4e-9 is 1.2000000000000002e-08
+        new.append((n // f, float('{:.12g}'.format(d * f)),
+                    base - 0.5 * d + 0.5 * d * f))
+
+    if [n for n, d, base in new] == [nx, ny, nz]:
+        raise Exception('No direction of the {}x{}x{} mesh can be coarsened '
+                        'by {}'.format(nx, ny, nz, factor))
+
+    (nx, dx, xbase), (ny, dy, ybase), (nz, dz, zbase) = new
+    return (nx, ny, nz, dx, dy, dz, xbase, ybase, zbase)
+
+
+def _interpolation_weights(xs, new_xs):
+    """
+    Indexes of the two closest values of xs (sorted) for every value of
+    new_xs, and the weight of the second one, for linear interpolation.
+    Values outside the range of xs take the value at the boundary
+    """
+    if len(xs) == 1:
+        i = np.zeros(len(new_xs), dtype=int)
+        return i, i, np.zeros(len(new_xs))
+
+    i1 = np.clip(np.searchsorted(xs, new_xs), 1, len(xs) - 1)
+    i0 = i1 - 1
+    w = np.clip((new_xs - xs[i0]) / (xs[i1] - xs[i0]), 0, 1)
+    return i0, i1, w
+
+
+def resample(field_data, geometry, new_geometry, normalised=True):
+    """
+    Interpolates (trilinearly) a (nz, ny, nx, 3) field, defined on the mesh
+    of geometry, at the cell centres of new_geometry, e.g. to refine a state
+    relaxed on a coarse mesh (see coarse_geometry). The vectors of the
+    result are normalised if normalised is True
+
+    Returns a (new nz, new ny, new nx, 3) array
+    """
+    field_data = np.asarray(field_data, dtype=np.float64).reshape(
+        geometry[2], geometry[1], geometry[0], 3)
+
+    # Interpolation along x (axis 2), y (axis 1) and z (axis 0)
+    for i, axis in [(0, 2), (1, 1), (2, 0)]:
+        xs = geometry[6 + i] + np.arange(geometry[i]) * geometry[3 + i]
+        new_xs = (new_geometry[6 + i] +
+                  np.arange(new_geometry[i]) * new_geometry[3 + i])
+        i0, i1, w = _interpolation_weights(xs, new_xs)
+
+        shape = [1, 1, 1, 1]
+        shape[axis] = len(w)
+        w = w.reshape(shape)
+        field_data = (field_data.take(i0, axis=axis) * (1 - w) +
+                      field_data.take(i1, axis=axis) * w)
+
+    if normalised:
+        normalise(field_data)
+    return field_data
+
+
+def resample_omf(omf_file, new_geometry, output_file,
+                 data_format='binary 8'):
+    """
+    Resamples the normalised magnetisation of an OMF file to the mesh of
+    new_geometry (see resample) and saves it in output_file, e.g. to use a
+    state relaxed on a coarse mesh as the initial state of an OOMMF
+    simulation with Oxs_FileVectorField
+
+    Returns the path of the new file
+    """
+    if not isinstance(omf_file, OOMMFDataRead):
+        omf_file = OOMMFDataRead(omf_file)
+    omf_file.read_m()
+    field_data = resample(omf_file.m, omf_file.geometry(), new_geometry)
+    del omf_file.m, omf_file.mx, omf_file.my, omf_file.mz
+
+    write_omf(output_file, field_data, new_geometry, data_format=data_format,
+              title='Resampled {}'.format(omf_file.header.get('Title', 'm')),
+              units='')
+    return output_file
+
+
+# -----------------------------------------------------------------------------
+# Compressed archives of OMF files
+#
+# An archive is a zip file with the OMF header as text and the raw field data
+# of every z-layer as a zlib compressed .npy entry, so layers can be read
+# independently
+
+
+ARCHIVE_MAGIC = b'PK\x03\x04'
+ARCHIVE_HEADER = 'header.txt'
+ARCHIVE_LAYER = 'layer_{:05d}.npy'
+
+
+def omf_to_archive(omf_file, archive_file=None, float32=False,
+                   compresslevel=6):
+    """
+    Converts an OMF file into a compressed archive, which can be read with
+    OOMMFDataRead (and OMFSeries with pattern='*.omfz')
+
+    Parameters:
+
+        omf_file        :: path of the OMF file
+        archive_file    :: path of the archive, by default the OMF path
+                           with the .omfz extension
+        float32         :: save the data in single precision (always done
+                           for 'binary 4' OMF files)
+        compresslevel   :: zlib compression level
+
+    Returns the path of the archive
+    """
+    if archive_file is None:
+        archive_file = os.path.splitext(omf_file)[0] + '.omfz'
+
+    omf = OOMMFDataRead(omf_file)
+    if float32 or omf.data_format == 'binary 4':
+        dtype = np.float32
+    else:
+        dtype = np.float64
+
+    # Written to a temporary file first, so an interrupted conversion does
+    # not leave an incomplete archive
+    tmp_file = archive_file + '.tmp'
+    with zipfile.ZipFile(tmp_file, 'w', compression=zipfile.ZIP_DEFLATED,
+                         compresslevel=compresslevel) as archive:
+        archive.writestr(ARCHIVE_HEADER, omf.header_text)
+        for k in range(omf.nz):
+            with archive.open(ARCHIVE_LAYER.format(k), 'w') as layer:
+                np.lib.format.write_array(
+                    layer, np.ascontiguousarray(omf.read_layer_data(k),
+                                                dtype=dtype))
+    os.replace(tmp_file, archive_file)
+
+    return archive_file
+
+
+def archive_to_omf(archive_file, omf_file=None, data_format='binary 8'):
+    """
+    Writes the data of a compressed archive back into an OMF file, e.g. to
+    use it with Oxs_FileVectorField
+
+    Returns the path of the OMF file
+    """
+    if omf_file is None:
+        omf_file = os.path.splitext(archive_file)[0] + '.omf'
+
+    omf = OOMMFDataRead(archive_file)
+    write_omf(omf_file, omf.read_data(), omf.geometry(),
+              data_format=data_format,
+              title=omf.header.get('Title', 'm'),
+              units=(omf.header.get('valueunits', '').split() or [''])[0])
+
+    return omf_file
+
+
+def archive_folder(folder, float32=False, remove=False):
+    """
+    Converts all the OMF files in a folder (e.g. the states of a sweep) into
+    compressed archives. If remove is True, the OMF files are deleted after
+    their conversion
+
+    Returns the list of archives
+    """
+    archives = []
+    for omf_file in sorted(glob.glob(os.path.join(folder, '*.omf'))):
+        archives.append(omf_to_archive(omf_file, float32=float32))
+        if remove:
+            os.remove(omf_file)
+
+    return archives
+
+
+# -----------------------------------------------------------------------------
+# Level-of-detail pyramids of OMF files, for plots of large meshes
+
+
+LOD_LEVELS = (2, 4, 8)
+
+
+def block_axis(xs, factor):
+    """
+    Returns the centres of the blocks of factor consecutive values of the
+    axis xs (the last block is smaller if len(xs) is not a multiple of factor)
+    """
+    starts = np.arange(0, len(xs), factor)
+    counts = np.diff(np.append(starts, len(xs)))
+    return np.add.reduceat(xs, starts) / counts
+
+
+def block_average(field_data, factor):
+    """
+    Averages the vectors of a (..., ny, nx, 3) array over blocks of
+    factor x factor cells in the xy plane and normalises them. The result
+    has shape (..., ceil(ny / factor), ceil(nx / factor), 3)
+    """
+    if factor == 1:
+        return normalise(np.array(field_data, dtype=np.float64))
+
+    ny, nx = field_data.shape[-3:-1]
+    # The block sums have the direction of the averages
+    block_sum = np.add.reduceat(field_data, np.arange(0, nx, factor), axis=-2)
+    block_sum = np.add.reduceat(block_sum, np.arange(0, ny, factor), axis=-3)
+    return normalise(block_sum.astype(np.float64))
+
+
+def lod_level(nx, n_pixels, levels=LOD_LEVELS):
+    """
+    Returns the coarsest level (block size) in levels with at least n_pixels
+    cells along x, e.g. the width in pixels of an image, or 1 (the full
+    resolution) if there is none
+    """
+    for level in sorted(levels, reverse=True):
+        if -(-nx // level) >= n_pixels:
+            return level
+    return 1
+
+
+class LODPyramid(object):
+    """
+    Level-of-detail pyramid of an OMF file: the normalised magnetisation of
+    every z-layer averaged over blocks of 2x2, 4x4 and 8x8 cells in the xy
+    plane (see block_average) plus its RGBA colours (generate_colours), to
+    plot large meshes at the resolution of the figure. Levels are given by
+    their block size, where 1 is the full resolution of the file
+
+    The pyramid is saved next to the OMF file, as FILE.lod.npz, and it is
+    computed again when the OMF file is modified
+
+    Parameters:
+
+        omf_file        :: path of the OMF file or OOMMFDataRead object
+        levels          :: block sizes of the levels
+        cache           :: load and save the pyramid file
+
+    Example:
+
+        lod = LODPyramid('m_Bz100mT-Oxs_MinDriver-Magnetization-00-0001.omf')
+        level = lod.level_for(300)
+        xs, ys = lod.axes(level)
+        plt.imshow(lod.rgba(20, level), origin='lower',
+                   extent=lod.extent(level))
+    """
+
+    def __init__(self, omf_file, levels=LOD_LEVELS, cache=True):
+        if not isinstance(omf_file, OOMMFDataRead):
+            omf_file = OOMMFDataRead(omf_file)
+        self.omf_file = omf_file
+        self.levels = tuple(sorted(levels))
+        self.cache_file = omf_file.input_file + '.lod.npz'
+
+        self.data = self.load() if cache else None
+        if self.data is None:
+            self.data = self.compute()
+            if cache:
+                self.save()
+
+    def source_stat(self):
+        stat = os.stat(self.omf_file.input_file)
+        return np.array([stat.st_mtime_ns, stat.st_size], dtype=np.int64)
+
+    def load(self):
+        """
+        Returns the dictionary of arrays of the pyramid file, or None if it
+        does not exist, it is outdated or it lacks any of the levels
+        """
+        if not os.path.exists(self.cache_file):
+            return None
+        try:
+            with np.load(self.cache_file) as f:
+                data = {k: f[k] for k in f.files}
+        except (OSError, ValueError, zipfile.BadZipFile):
+            return None
+
+        if not np.array_equal(data.get('source_stat'), self.source_stat()):
+            return None
+        if not all('m_{}'.format(level) in data for level in self.levels):
+            return None
+        return data
+
+    def save(self):
+        tmp_file = self.cache_file + '.tmp'
+        with open(tmp_file, 'wb') as f:
+            np.savez(f, **self.data)
+        os.replace(tmp_file, self.cache_file)
+
+    def compute(self):
+        """
+        Computes the levels layer by layer, thus only one layer of the OMF
+        file is loaded at a time
+        """
+        omf = self.omf_file
+        data = {'source_stat': self.source_stat()}
+        for level in self.levels:
+            data['m_{}'.format(level)] = np.empty(
+                (omf.nz, -(-omf.ny // level), -(-omf.nx // level), 3),
+                dtype=np.float32)
+
+        for k in range(omf.nz):
+            layer = omf.read_layer_data(k)
+            for level in self.levels:
+                data['m_{}'.format(level)][k] = block_average(layer, level)
+
+        for level in self.levels:
+            data['rgba_{}'.format(level)] = generate_colours(
+                data['m_{}'.format(level)], colour_model='rgba')
+
+        return data
+
+    def level_for(self, n_pixels):
+        """
+        Returns the coarsest level with at least n_pixels cells along x
+        """
+        return lod_level(self.omf_file.nx, n_pixels, self.levels)
+
+    def m(self, k, level=1):
+        """
+        Returns the normalised magnetisation of the z-layer k at a level
+        """
+        if level == 1:
+            return self.omf_file.read_layer(k)
+        return self.data['m_{}'.format(level)][k]
+
+    def rgba(self, k, level=1):
+        """
+        Returns the RGBA colours (uint8) of the z-layer k at a level
+        """
+        if level == 1:
+            return generate_colours(self.m(k), colour_model='rgba')
+        return self.data['rgba_{}'.format(level)][k]
+
+    def axes(self, level=1):
+        """
+        Returns the x and y coordinates (nm) of the cells of a level
+        """
+        return (block_axis(self.omf_file.xs, level),
+                block_axis(self.omf_file.ys, level))
+
+    def extent(self, level=1):
+        """
+        Returns the extent of the level images for matplotlib's imshow. It
+        is the same for all levels, i.e. the size of the sample
+        """
+        omf = self.omf_file
+        return [omf.xmin * 1e9, omf.xmax * 1e9, omf.ymin * 1e9, omf.ymax * 1e9]
+
+
+# -----------------------------------------------------------------------------
+# Streaming reductions
+#
+# The data of an OMF file is read in chunks of a fixed number of cells, so
+# the memory used by the reductions does not depend on the mesh size
+
+
+CHUNK_SIZE = 2 ** 18
+
+
+def iter_chunks(omf_file, chunk_size=CHUNK_SIZE, normalised=True):
+    """
+    Generator of the data of an OMF file in chunks of chunk_size cells (in
+    the order of the file, x changes fastest). Every chunk is yielded as
+    (start, data) where start is the index of its first cell and data is a
+    (n, 3) array, normalised if normalised is True
+
+    Parameters:
+
+        omf_file        :: path of the OMF file or OOMMFDataRead object
+    """
+    if not isinstance(omf_file, OOMMFDataRead):
+        omf_file = OOMMFDataRead(omf_file)
+    n_cells = omf_file.nx * omf_file.ny * omf_file.nz
+
+    def chunks():
+        if omf_file.data_format == 'text':
+            with open(omf_file.input_file, 'rb') as _file:
+                _file.seek(omf_file.data_offset)
+                start = 0
+                while start < n_cells:
+                    lines = itertools.islice(_file,
+                                             min(chunk_size, n_cells - start))
+                    data = np.fromstring(b''.join(lines).decode('latin-1'),
+                                         sep=' ').reshape(-1, 3)
+                    if len(data) == 0:
+                        raise Exception('Incomplete data in {}'.format(
+                                        omf_file.input_file))
+                    yield start, data
+                    start += len(data)
+
+        elif omf_file.data_format == 'archive':
+            # Layers are the compressed units of the archives
+            n_layer = omf_file.nx * omf_file.ny
+            for k in range(omf_file.nz):
+                layer = omf_file.read_layer_data(k).reshape(-1, 3)
+                for i in range(0, n_layer, chunk_size):
+                    yield k * n_layer + i, layer[i:i + chunk_size]
+
+        else:
+            data = omf_file.read_data()
+            for start in range(0, n_cells, chunk_size):
+                yield start, data[start:start + chunk_size]
+
+    for start, data in chunks():
+        data = np.array(data, dtype=np.float64)
+        if normalised:
+            normalise(data)
+        yield start, data
+
+
+def reduce_omf(omf_file, chunk_size=CHUNK_SIZE, bins=100, mz_range=(-1, 1),
+               normalised=True):
+    """
+    Computes reductions of the magnetisation of an OMF file reading its
+    data in chunks (see iter_chunks), thus using a fixed amount of memory
+
+    Returns a dictionary with:
+
+        mean            :: (3,) average of the magnetisation
+        layer_mean      :: (nz, 3) average of every z-layer
+        min, max        :: (3,) minimum and maximum of every component
+        mz_histogram    :: (bins,) number of cells with m_z in the bins
+                           (values outside mz_range are not counted)
+        mz_bin_edges    :: (bins + 1,) edges of the histogram bins
+
+    With normalised=False the reductions are computed from the raw data,
+    e.g. in A/m, and mz_range should be set accordingly
+    """
+    if not isinstance(omf_file, OOMMFDataRead):
+        omf_file = OOMMFDataRead(omf_file)
+    n_layer = omf_file.nx * omf_file.ny
+    nz = omf_file.nz
+
+    layer_sum = np.zeros((nz, 3))
+    m_min = np.full(3, np.inf)
+    m_max = np.full(3, -np.inf)
+
+    bin_edges = np.linspace(mz_range[0], mz_range[1], bins + 1)
+    histogram = np.zeros(bins, dtype=np.int64)
+
+    for start, chunk in iter_chunks(omf_file, chunk_size, normalised):
+        # Chunks can span several layers
+        layers = np.arange(start, start + len(chunk)) // n_layer
+        for i in range(3):
+            layer_sum[:, i] += np.bincount(layers, weights=chunk[:, i],
+                                           minlength=nz)
+        np.minimum(m_min, chunk.min(axis=0), out=m_min)
+        np.maximum(m_max, chunk.max(axis=0), out=m_max)
+        histogram += np.histogram(chunk[:, 2], bins=bin_edges)[0]
+
+    return {'mean': layer_sum.sum(axis=0) / (n_layer * nz),
+            'layer_mean': layer_sum / n_layer,
+            'min': m_min,
+            'max': m_max,
+            'mz_histogram': histogram,
+            'mz_bin_edges': bin_edges,
+            }
+
+
+def stream_reductions(series, chunk_size=CHUNK_SIZE, bins=100):
+    """
+    Generator of the reductions (see reduce_omf) of the states of a sweep,
+    one state at a time. It yields (parameters, reductions) tuples
+
+    Parameters:
+
+        series      :: OMFSeries, folder, or list of OMF files
+    """
+    if isinstance(series, str):
+        series = OMFSeries(series)
+
+    if isinstance(series, OMFSeries):
+        for parameters, omf_file in series:
+            yield parameters, reduce_omf(omf_file, chunk_size, bins)
+    else:
+        for omf_file in series:
+            yield (parse_parameters(omf_file),
+                   reduce_omf(omf_file, chunk_size, bins))
+
+
+def mean_magnetisation_curve(series, key='Bz', chunk_size=CHUNK_SIZE):
+    """
+    Returns the values of the parameter key (e.g. the applied field) of the
+    states of a sweep, sorted, and the average magnetisation of the states
+    as an (n_states, 3) array, e.g. to plot the hysteresis curve <m_z>(Bz):
+
+        Bz, m = mean_magnetisation_curve('omfs_folder')
+        plt.plot(Bz, m[:, 2])
+    """
+    values, means = [], []
+    for parameters, reductions in stream_reductions(series, chunk_size):
+        values.append(parameters[key])
+        means.append(reductions['mean'])
+
+    order = np.argsort(values, kind='stable')
+    return np.array(values)[order], np.array(means).reshape(-1, 3)[order]
+
+
+# -----------------------------------------------------------------------------
+
+
+# Names of the parameters in the file and folder names of the simulations
+PARAMETER_NAMES = ('mu0Ms', 'rseed', 'Bz', 'A', 'L', 't')
+# Number and optional units of a parameter
+PARAMETER_VALUE = (r'([-+]?\d+(?:\.\d+)?(?:e[-+]?\d+)?)'
+                   r'(?:[A-Za-z][A-Za-z\-0-9]*)?')
+
+
+def parse_parameters(filename, root=None, names=PARAMETER_NAMES):
+    """
+    Returns a dictionary with the numerical parameters in the path of an
+    OOMMF output file, from the folder names and the file name, e.g.
+
+        omfs_mu0Ms_0450mT_A_20pJm-1/m_Bz050mT-Oxs_MinDriver-...-00-0016933.omf
+            --> {'mu0Ms': 450.0, 'A': 20.0, 'Bz': 50.0, 'stage': 0,
+                 'iteration': 16933}
+
+        omfs_L800nm_t200nm/typeII_bubble_Bz260mT_field-sweep-Oxs_...
+            --> {'L': 800.0, 't': 200.0, 'Bz': 260.0, 'stage': ...,
+                 'iteration': ...}
+
+    Parameters are the '_' separated words made of one of the names
+    followed by a number and, optionally, its units (e.g. Bz050mT), or a
+    word with the name followed by a word with the number (mu0Ms_0450mT).
+    Values are the numbers as written (450 for 0450mT). Every component
+    of the path relative to root (by default the path as it is given) is
+    parsed, and parameters of the file name take precedence over those
+    of folders
+    """
+    if root is not None:
+        filename = os.path.relpath(filename, root)
+    components = os.path.normpath(filename).split(os.sep)
+    name = components[-1]
+    parameters = {}
+
+    oxs = re.search(r'-Oxs_\w+-\w+-(\d+)-(\d+)\.\w+$', name)
+    if oxs:
+        components[-1] = name[:oxs.start()]
+    else:
+        components[-1] = os.path.splitext(name)[0]
+
+    value = re.compile(PARAMETER_VALUE + '$')
+    for component in components:
+        words = component.split('_')
+        for i, word in enumerate(words):
+            for n in names:
+                if not word.startswith(n):
+                    continue
+                if word == n and i + 1 < len(words):
+                    p = value.match(words[i + 1])
+                else:
+                    p = value.match(word[len(n):])
+                if p:
+                    parameters[n] = float(p.group(1))
+                    break
+
+    if oxs:
+        parameters['stage'] = int(oxs.group(1))
+        parameters['iteration'] = int(oxs.group(2))
+
+    return parameters
+
+
+class OMFSeries(object):
+    """
+    Class to read a series of OMF files sharing the same mesh, e.g. the
+    states of a field sweep, from a folder or a glob pattern
+
+    Headers are read once when creating the series, checking that all the
+    files have the same mesh, and the coordinates (if requested with
+    set_coordinates) are generated a single time. States can be accessed by index or by their parameters:
+
+        series = OMFSeries('omfs_L800nm_t200nm/')
+        for parameters, omf_file in series:
+            m_layer = omf_file.read_layer(20)
+
+        omf_file = series.find(Bz=260)
+        omf_file.read_m()
+
+    Every state is an OOMMFDataRead object
+    """
+
+    def __init__(self, path, pattern='*.omf'):
+
+        if os.path.isdir(path):
+            file_list = glob.glob(os.path.join(path, pattern))
+        else:
+            file_list = glob.glob(path)
+
+        if not file_list:
+            raise Exception('No OMF files found in {}'.format(path))
+
+        # Sort the files by their parameters (following the order they
+        # appear in the paths) and then by name
+        states = [(parse_parameters(f), f) for f in file_list]
+        states.sort(key=lambda s: (list(s[0].values()), s[1]))
+        self.parameters = [s[0] for s in states]
+        self.files = [s[1] for s in states]
+
+        self.states = [OOMMFDataRead(f) for f in self.files]
+
+        geometry = self.states[0].geometry()
+        for omf_file in self.states[1:]:
+            if omf_file.geometry() != geometry:
+                raise Exception('Mesh of {} is different from {}'.format(
+                                omf_file.input_file, self.files[0]))
+
+        (self.nx, self.ny, self.nz,
+         self.dx, self.dy, self.dz,
+         self.xbase, self.ybase, self.zbase) = geometry
+        self.xs, self.ys, self.zs = (self.states[0].xs,
+                                     self.states[0].ys,
+                                     self.states[0].zs)
+
+    def meshgrid(self):
+        return self.states[0].meshgrid()
+
+    def geometry(self):
+        return self.states[0].geometry()
 
     def set_coordinates(self):
-        xs, ys, zs = (np.arange(float(self.nx)),
-                      np.arange(float(self.ny)),
-                      np.arange(float(self.nz))
-                      )
-        xs *= self.dx
-        xs += self.xbase
-        ys *= self.dy
-        ys += self.ybase
-        zs *= self.dz
-        zs += self.zbase
-
-        xs = np.tile(np.tile(xs, self.ny), self.nz)
-        ys = np.tile(np.repeat(ys, self.nx), self.nz)
-        zs = np.repeat(zs, self.nx * self.ny)
-
-        # int(len(xs), len(ys), len(zs))
-
-        # self.coordinates = np.ravel(np.column_stack((xs, ys, zs))) * 1e9
-        self.coordinates = np.column_stack((xs, ys, zs)) * 1e9
+        # Full coordinates are only generated on demand
+        for omf_file in self.states:
+            omf_file.set_coordinates()
+
+        self.coordinates = self.states[0].coordinates
         self.x, self.y, self.z = (self.coordinates[:, 0],
                                   self.coordinates[:, 1],
                                   self.coordinates[:, 2])
 
+    def find(self, **parameters):
+        """
+        Returns the first state matching the specified parameters
+        """
+        for p, omf_file in self:
+            if all(k in p and np.isclose(p[k], v)
+                   for k, v in parameters.items()):
+                return omf_file
+
+        raise Exception('No state found with parameters {}'.format(
+                        parameters))
+
+    def __len__(self):
+        return len(self.states)
+
+    def __getitem__(self, i):
+        return self.states[i]
+
+    def __iter__(self):
+        return iter(zip(self.parameters, self.states))
+
 
 # -----------------------------------------------------------------------------
 
 
+def split_tcl_list(line):
+    """
+    Splits a line with a Tcl list, as the Columns and Units lines of an ODT
+    file, where elements with spaces are quoted with braces (or the spaces
+    are escaped with backslashes), e.g.
+
+        'Oxs_MinDriver::Iteration {Oxs_CGEvolve::Total energy} {}'
+            --> ['Oxs_MinDriver::Iteration', 'Oxs_CGEvolve::Total energy', '']
+    """
+    return [m.group(1) if m.group(1) is not None
+            else re.sub(r'\\(.)', r'\1', m.group(2))
+            for m in re.finditer(r'\{([^}]*)\}|((?:\\.|\S)+)', line)]
+
+
 class OOMMFODTRead(object):
 
     """
@@ -125,44 +1477,158 @@ class OOMMFODTRead(object):
 
         data = OOMMFODTRead(my_odt_file)
         total_energy = data['Oxs_CGEvolve::Total energy']
+
+    To parse only some of the columns, specify them in a list:
+
+        data = OOMMFODTRead(my_odt_file,
+                            columns=['Oxs_CGEvolve::Total energy',
+                                     'Oxs_CGEvolve::Max mxHxm'])
+
+    (other columns are read from the file when they are requested, and no
+    data is read with an empty list). Large files can be parsed with
+    several workers processes (see parse_text)
     """
 
-    def __init__(self, input_file):
+    def __init__(self, input_file, columns=None, workers=1):
 
         self.input_file = input_file
+        self.workers = workers
         self.read_header()
-        # Load the ODT file numerical data
-        self.data = np.loadtxt(self.input_file)
+
+        if columns is None:
+            columns = list(self.columns.keys())
+        self.read_columns(columns)
 
     def read_header(self):
-        f = open(self.input_file)
-
-        # Read the third line which has the header names
-        i = 0
-        for i in range(4):
-            l = f.readline()
-        f.close()
-        # Remove the starting "# Columns:" string
-        l = l[11:]
-
-        # Separate the header strings:
-        # re.split('}\s{|\s\s\s\s|\s{|\sOxs', l)
-        header = re.findall(r'Oxs_[A-Za-z\s\:}]+(?=Oxs|{Oxs|\n)', l)
+        """
+        Reads the column names and units from the '# Columns:' and
+        '# Units:' lines of the first table in the file
+        """
+        header = {}
+        with open(self.input_file) as f:
+            for line in f:
+                if not line.startswith('#'):
+                    break
+                field = re.match(r'^#\s*(Columns|Units):(.*)$', line)
+                if field:
+                    header[field.group(1)] = split_tcl_list(field.group(2))
+
+        if 'Columns' not in header:
+            raise Exception('No columns found in {}'.format(self.input_file))
+
         # Assign the name and column number
         self.columns = {}
-        for i, h in enumerate(header):
-            h = h.strip()
-            h = h.strip('}')
-            self.columns[h] = i
+        for i, h in enumerate(header['Columns']):
+            self.columns[h.strip()] = i
+
+        units = header.get('Units', [''] * len(self.columns))
+        self.units = dict(zip(self.columns.keys(), units))
+
+    def check_column(self, column_name):
+        if column_name not in self.columns.keys():
+            raise Exception('Invalid column name: {}. \n'.format(column_name) +
+                            'Options:\n' + '\n'.join(self.columns.keys())
+                            )
+
+    def read_columns(self, columns):
+        """
+        Loads the numerical data of the specified columns
+        """
+        for c in columns:
+            self.check_column(c)
+
+        if not columns:
+            self.data = np.empty((0, 0))
+            self.data_columns = {}
+            return
+
+        usecols = [self.columns[c] for c in columns]
+        # Comment lines (table start/end and headers of appended tables)
+        # are skipped. Large files are parsed by several processes
+        self.data = parse_text(self.input_file, len(self.columns),
+                               usecols=usecols, workers=self.workers)
+        self.data_columns = {c: i for i, c in enumerate(columns)}
 
     def __getitem__(self, column_name):
         """
         Returns the correspondign column from the name when calling
         an element of this Class through []
         """
-        if column_name not in self.columns.keys():
-            raise Exception('Invalid column name: {}. \n'.format(column_name) +
-                            'Options:\n' + '\n'.join(self.columns.keys())
-                            )
+        self.check_column(column_name)
+
+        if column_name not in self.data_columns:
+            self.read_columns(list(self.data_columns.keys()) + [column_name])
+
+        return self.data[:, self.data_columns[column_name]]
+
+
+def last_odt_row(input_file, block_size=65536):
+    """
+    Returns the last data row of an ODT file, i.e. the final state of the
+    simulation, reading only the end of the file
+    """
+    with open(input_file, 'rb') as f:
+        f.seek(0, os.SEEK_END)
+        size = f.tell()
+        f.seek(max(0, size - block_size))
+        lines = f.read().decode('latin-1').splitlines()
+
+    for line in reversed(lines):
+        line = line.strip()
+        if line and not line.startswith('#'):
+            return np.array(line.split(), dtype=np.float64)
+
+    raise Exception('No data found in {}'.format(input_file))
+
+
+def read_odt_table(odt_files, columns, rows='last'):
+    """
+    Reads the specified columns from many ODT files, e.g. from all the
+    simulations of a sweep, into a single table. The table is a dictionary
+    of arrays with the parameters from the file paths (see
+    parse_parameters), the requested columns and a 'file' column:
+
+        table = read_odt_table('omfs_L800nm_t200nm/*.odt',
+                               ['Oxs_CGEvolve::Total energy'])
+        plt.plot(table['Bz'], table['Oxs_CGEvolve::Total energy'])
+
+    Parameters:
+
+        odt_files       :: list of ODT files or a glob pattern
+        columns         :: list of column names
+        rows            :: 'last' to read only the final row of every file
+                           or 'all' to read all the rows
+
+    Rows are sorted by the parameters of the files
+    """
+    if isinstance(odt_files, str):
+        odt_files = glob.glob(odt_files)
+
+    runs = [(parse_parameters(f), f) for f in odt_files]
+    runs.sort(key=lambda r: (list(r[0].values()), r[1]))
+
+    parameter_names = []
+    for p, f in runs:
+        parameter_names += [k for k in p.keys() if k not in parameter_names]
+
+    table = {k: [] for k in parameter_names + list(columns) + ['file']}
+    for p, f in runs:
+        if rows == 'last':
+            odt = OOMMFODTRead(f, columns=[])
+            for c in columns:
+                odt.check_column(c)
+            data = last_odt_row(f)[[odt.columns[c] for c in columns]]
+            data = data[np.newaxis, :]
+        elif rows == 'all':
+            data = OOMMFODTRead(f, columns=columns).data
+        else:
+            raise Exception('Specify a valid option for rows: last or all')
+
+        for i, c in enumerate(columns):
+            table[c].append(data[:, i])
+        for k in parameter_names:
+            table[k].append(np.full(len(data), p.get(k, np.nan)))
+        table['file'].append(np.full(len(data), f, dtype=object))
 
-        return self.data[:, self.columns[column_name]]
+    return {k: (np.concatenate(v) if v else np.array([]))
+            for k, v in table.items()}
@@ -5,14 +5,55 @@ Run simulations by varying Ms and A parameters
 Each simulation is a field sweep from 0 to 0.3 T in 6 steps, i.e in steps of
 0.5 T
 
+Simulations are run locally with several OOMMF processes at the same time,
+using the available cores (it can be specified as the first argument of this
+script). Exit status and wall time of every run are saved in
+sweep_manifest.jsonl
+
+With CONTINUATION, the field sweep of every (Ms, A) pair starts from the
+relaxed state of the previous field instead of the bubble lattice initial
+state (fields are swept in ascending order, or descending with DESCENDING)
+
+With ADAPTIVE, a coarse (Ms, A, Bz) grid is simulated first and new
+simulations are run only between neighbouring points where the relaxed
+states are different, to resolve the boundaries of the phase diagram
+
+With SUPERVISE, the ODT files are followed while OOMMF runs and runs that
+stall, diverge or take longer than BUDGET seconds are killed (see
+oommf_supervisor). The state of the sweep is in sweep_status.json
+
 """
 
 # import glob
 # import re
 import subprocess
 import os
+import json
+import sys
 import numpy as np
 import textwrap
+sys.path.append('../../../')
+import oommf_sweep as osw
+import oommf_supervisor as osu
+import oommf_tools as ot
+import initial_states as ist
+
+# Set to True to submit every simulation to a cluster with sbatch
+CLUSTER = False
+CORES = int(sys.argv[1]) if len(sys.argv) > 1 else None
+CONTINUATION = False
+DESCENDING = False
+# Generate the bubble lattice initial state with numpy and load it from an
+# OMF file, instead of evaluating the bubble_lattice Tcl script in every cell
+INIT_OMF = True
+# Relax every simulation first on meshes with cells COARSE_FACTORS times
+# larger, e.g. (4, 2), and refine the relaxed state (see osw.coarse_to_fine)
+COARSE_FACTORS = ()
+# Adaptive sweep (see osw.adaptive_sweep) instead of the full grid
+ADAPTIVE = False
+# Kill stalled, diverged or over budget runs (wall time in seconds, or None)
+SUPERVISE = False
+BUDGET = None
 
 
 def SIM_TXT(Ms, A, BzMax, SAVE_FOLDER):
@@ -45,27 +86,110 @@ def SIM_TXT(Ms, A, BzMax, SAVE_FOLDER):
                                               SAVE_FOLDER)
     return pre + sim
 
-# Test:
-# SAVE_FOLDER = 'omfs_mu0Ms_{:04.0f}mT_A_{:02.0f}pJm-1'.format(0.4 * 1000, 10.)
-# print(SIM_TXT(0.4, 10., 300, SAVE_FOLDER))
 
-for Ms in np.arange(0.4, 0.7, 0.05):
+def SIM_PARAMETERS(Ms, A, Bz, SAVE_FOLDER):
+    parameters = {'Ms': '{}'.format(Ms),
+                  'A': '{:.0f}e-12'.format(A),
+                  'Bz': '{}e-3'.format(int(Bz)),
+                  'BASENAME': '{}/m_Bz{:03d}mT'.format(SAVE_FOLDER, int(Bz))
+                  }
+    if INIT_OMF:
+        parameters['OMFFILE'] = INIT_OMF_FILE
+    return parameters
 
-    for A in [10., 15., 20., 25., 30., 35.]:
 
-        # Make folder to save omf files
-        SAVE_FOLDER = 'omfs_mu0Ms_{:04.0f}mT_A_{:02.0f}pJm-1'.format(Ms * 1000,
-                                                                     A)
-        if os.path.exists(SAVE_FOLDER):
-            os.rmdir(SAVE_FOLDER)
-        os.mkdir(SAVE_FOLDER)
+# Mesh of oommf_bubble_lattice.mif
+geometry = ot.mesh_geometry((-500e-9, -500e-9, -100e-9),
+                            (500e-9, 500e-9, 100e-9),
+                            (5e-9, 5e-9, 5e-9))
+INIT_OMF_FILE = 'init_bubble_lattice.omf'
 
-        for Bz in np.arange(0, 301, 50):
+# Test:
+# SAVE_FOLDER = 'omfs_mu0Ms_{:04.0f}mT_A_{:02.0f}pJm-1'.format(0.4 * 1000, 10.)
+# print(SIM_TXT(0.4, 10., 300, SAVE_FOLDER))
 
-            F = open('submit', 'w')
-            F.write(SIM_TXT(Ms, A, Bz, SAVE_FOLDER))
-            F.close()
 
-            # If submitting to a cluster:
-            # subprocess.call('sbatch submit', shell=True)
-            subprocess.call('bash submit', shell=True)
+def MAKE_SAVE_FOLDER(Ms, A):
+    # Make folder to save omf files
+    SAVE_FOLDER = 'omfs_mu0Ms_{:04.0f}mT_A_{:02.0f}pJm-1'.format(Ms * 1000, A)
+    # (results of previous runs are kept, finished runs are skipped)
+    if not os.path.exists(SAVE_FOLDER):
+        os.mkdir(SAVE_FOLDER)
+    return SAVE_FOLDER
+
+
+def MAKE_JOB(point):
+    Ms, A, Bz = point['Ms'], point['A'], point['Bz']
+    return osw.SweepJob('oommf_bubble_lattice.mif',
+                        SIM_PARAMETERS(Ms, A, Bz, MAKE_SAVE_FOLDER(Ms, A)))
+
+
+# The sweep runs under this block since the data of the OMF files can be
+# parsed by several processes (see ot.parse_text)
+if __name__ == '__main__':
+    if INIT_OMF:
+        ist.write_initial_state(INIT_OMF_FILE,
+                                ist.hexagonal_bubble_lattice(geometry),
+                                geometry)
+
+    jobs = []
+    if not ADAPTIVE:
+        for Ms in np.arange(0.4, 0.7, 0.05):
+
+            for A in [10., 15., 20., 25., 30., 35.]:
+
+                SAVE_FOLDER = MAKE_SAVE_FOLDER(Ms, A)
+
+                field_jobs = []
+                for Bz in np.arange(0, 301, 50):
+
+                    if CLUSTER:
+                        F = open('submit', 'w')
+                        F.write(SIM_TXT(Ms, A, Bz, SAVE_FOLDER))
+                        F.close()
+                        subprocess.call('sbatch submit', shell=True)
+                    else:
+                        field_jobs.append(
+                            MAKE_JOB({'Ms': Ms, 'A': A, 'Bz': Bz}))
+
+                if CONTINUATION and field_jobs:
+                    field_jobs = [osw.field_continuation(
+                        field_jobs, key='Bz', descending=DESCENDING)]
+                if COARSE_FACTORS:
+                    field_jobs = [osw.coarse_to_fine(chain, geometry,
+                                                     COARSE_FACTORS)
+                                  for chain in field_jobs]
+                jobs += field_jobs
+
+    if ADAPTIVE:
+        # Coarse grid, refined (down to the resolution) only between
+        # neighbours with different states: uniform, bubble lattice,
+        # isolated bubble or stripes. Parameter values are rounded to the
+        # resolution, thus A and Bz stay integers as in the names of the
+        # folders and files. The coarse grid is a subset of the full grid,
+        # thus the same ranges are covered (Ms 0.4 to 0.65, A 10 to 35)
+        results = osw.adaptive_sweep(
+            MAKE_JOB,
+            {'Ms': [0.4, 0.5, 0.6, 0.65],
+             'A': [10., 20., 30., 35.],
+             'Bz': [0., 100., 200., 300.]},
+            max_rounds=3,
+            resolution={'Ms': 0.01, 'A': 1., 'Bz': 10.},
+            total_cores=CORES)
+        with open('adaptive_sweep.json', 'w') as f:
+            json.dump([{'point': r['point'], 'class': r['class'],
+                        'energy': r['energy']} for r in results], f, indent=1)
+        records = [r['record'] for r in results]
+        osw.performance_report(records, keys=['Ms', 'A', 'Bz'],
+                               output='performance_report.json')
+
+    elif jobs:
+        if SUPERVISE:
+            records = osu.run_supervised(jobs, total_cores=CORES,
+                                         budget=BUDGET)
+        else:
+            records = osw.run_sweep(jobs, total_cores=CORES)
+        osw.iteration_savings(records)
+        # Failed runs and runs much slower than their neighbours in the sweep
+        osw.performance_report(records, keys=['Ms', 'A', 'Bz'],
+                               output='performance_report.json')
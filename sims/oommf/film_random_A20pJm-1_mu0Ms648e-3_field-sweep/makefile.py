@@ -1,27 +1,44 @@
 import glob
 import os
 import re
-import subprocess
+import sys
+sys.path.append('../../../')
+import oommf_sweep as osw
+import oommf_analysis as oa
 
+# Total number of cores for the OOMMF processes (default: all)
+CORES = int(sys.argv[1]) if len(sys.argv) > 1 else None
+# Count the bubbles, biskyrmions and stripes of all the seeds and fields
+# after the sweep (see oa.ensemble_census). The field of stage k is
+# k * BzMax / Bsteps
+CENSUS = True
 
-OMFS = glob.glob('../film_random_A20pJm-2_mu0Ms648e-3/*.omf')
+if __name__ == '__main__':
+    OMFS = glob.glob('../film_random_A20pJm-2_mu0Ms648e-3/*.omf')
 
-for OMF in OMFS[1:]:
-    OMFNAME = os.path.basename(OMF)
-    SEED = re.search('(?<=rseed)\d+(?=-)', OMFNAME).group(0)
-    SAVE_FOLDER = 'film_random_rseed{}_field-sweep_omfs'.format(SEED)
+    jobs = []
+    for OMF in OMFS[1:]:
+        OMFNAME = os.path.basename(OMF)
+        SEED = re.search('(?<=rseed)\d+(?=-)', OMFNAME).group(0)
+        SAVE_FOLDER = 'film_random_rseed{}_field-sweep_omfs'.format(SEED)
 
-    # Make folder to save omf files
-    if os.path.exists(SAVE_FOLDER):
-        os.rmdir(SAVE_FOLDER)
-    os.mkdir(SAVE_FOLDER)
+        # Make folder to save omf files
+        # (results of previous runs are kept, finished runs are skipped)
+        if not os.path.exists(SAVE_FOLDER):
+            os.mkdir(SAVE_FOLDER)
 
-    subprocess.call(('oommf boxsi -threads 8 '
-                     '-parameters '
-                     '"'
-                     'OMFFILE {0} '
-                     'BASENAME '
-                     '{1}/oommf_film_random_rseed{2}_field-sweep'
-                     '" '
-                     'oommf_film_random.mif').format(OMF, SAVE_FOLDER, SEED),
-                    shell=True)
+        jobs.append(osw.SweepJob(
+            'oommf_film_random.mif',
+            {'OMFFILE': OMF,
+             'BASENAME': '{}/oommf_film_random_rseed{}_field-sweep'.format(
+                 SAVE_FOLDER, SEED)
+             }))
+
+    records = osw.run_sweep(jobs, total_cores=CORES)
+    # Wall times, iterations and output sizes of the runs
+    osw.performance_report(records, output='performance_report.json')
+
+    if CENSUS:
+        census = oa.ensemble_census(
+            'film_random_rseed*_field-sweep_omfs/*.omf',
+            output='domain_census.npz')
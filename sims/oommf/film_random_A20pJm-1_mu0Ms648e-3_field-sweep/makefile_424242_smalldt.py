@@ -1,11 +1,16 @@
 import glob
 import os
 import re
-import subprocess
+import sys
+sys.path.append('../../../')
+import oommf_sweep as osw
 
+# Total number of cores for the OOMMF process (default: all)
+CORES = int(sys.argv[1]) if len(sys.argv) > 1 else None
 
 OMFS = glob.glob('../film_random_A20pJm-2_mu0Ms648e-3/*.omf')
 
+jobs = []
 for OMF in OMFS:
     OMFNAME = os.path.basename(OMF)
     SEED = re.search('(?<=rseed)\d+(?=-)', OMFNAME).group(0)
@@ -14,20 +19,21 @@ for OMF in OMFS:
     if SEED == '424242':
 
         # Make folder to save omf files
-        if os.path.exists(SAVE_FOLDER):
-            os.rmdir(SAVE_FOLDER)
-        os.mkdir(SAVE_FOLDER)
-
-        subprocess.call(('oommf boxsi -threads 8 '
-                         '-parameters '
-                         '"'
-                         'OMFFILE {0} '
-                         'Bsteps 60 '
-                         'BASENAME '
-                         '{1}/oommf_film_random_rseed{2}_field-sweep'
-                         '" '
-                         'oommf_film_random.mif').format(OMF, SAVE_FOLDER, SEED),
-                        shell=True)
+        # (results of previous runs are kept, finished runs are skipped)
+        if not os.path.exists(SAVE_FOLDER):
+            os.mkdir(SAVE_FOLDER)
+
+        jobs.append(osw.SweepJob(
+            'oommf_film_random.mif',
+            {'OMFFILE': OMF,
+             'Bsteps': '60',
+             'BASENAME': '{}/oommf_film_random_rseed{}_field-sweep'.format(
+                 SAVE_FOLDER, SEED)
+             }))
 
     else:
         continue
+
+records = osw.run_sweep(jobs, total_cores=CORES)
+# Wall times, iterations and output sizes of the runs
+osw.performance_report(records, output='performance_report.json')
@@ -1,31 +1,80 @@
 import glob
 import os
 import re
-import subprocess
+import sys
 import numpy as np
+sys.path.append('../../../')
+import oommf_sweep as osw
+import oommf_supervisor as osu
+import oommf_tools as ot
+import initial_states as ist
 
-for L in [600, 800, 1000, 1200, 1400]:
-
-    # Make folder to save omf files
-    SAVE_FOLDER = 'omfs_L{}nm_t200nm'.format(L)
-    if os.path.exists(SAVE_FOLDER):
-        os.rmdir(SAVE_FOLDER)
-    os.mkdir(SAVE_FOLDER)
-
-    # for Bz in np.arange(0.05, 0.26, 0.01):
-    for Bz in np.arange(40, 331, 10):
-
-        subprocess.call(('oommf boxsi -threads 6 '
-                         '-parameters '
-                         '"'
-                         'Lx {0}e-9 '
-                         'Ly {0}e-9 '
-                         'Lz 200e-9 '
-                         'Bz {1}e-3 '
-                         'BASENAME '
-                         '{2}/typeII_bubble_Bz{1:03d}mT_field-sweep'
-                         '" '
-                         'oommf_isolated_typeII_bubble.mif').format(int(L),
-                                                                    int(Bz),
-                                                                    SAVE_FOLDER),
-                        shell=True)
+# Total number of cores for the OOMMF processes (default: all)
+CORES = int(sys.argv[1]) if len(sys.argv) > 1 else None
+# Start every field from the relaxed state of the previous field (sweeping
+# in ascending order, or descending with DESCENDING)
+CONTINUATION = False
+DESCENDING = False
+# Generate the type II bubble initial state with numpy and load it from an
+# OMF file, instead of evaluating the typeIIbubble Tcl script in every cell
+INIT_OMF = True
+# Relax every simulation first on meshes with cells COARSE_FACTORS times
+# larger, e.g. (2,), and refine the relaxed state (see osw.coarse_to_fine)
+COARSE_FACTORS = ()
+# Follow the ODT files while OOMMF runs and kill the runs that stall, diverge
+# or take longer than BUDGET seconds (see oommf_supervisor)
+SUPERVISE = False
+BUDGET = None
+
+if __name__ == '__main__':
+    jobs = []
+    for L in [600, 800, 1000, 1200, 1400]:
+
+        # Make folder to save omf files
+        SAVE_FOLDER = 'omfs_L{}nm_t200nm'.format(L)
+        # (results of previous runs are kept, finished runs are skipped)
+        if not os.path.exists(SAVE_FOLDER):
+            os.mkdir(SAVE_FOLDER)
+
+        # Mesh of oommf_isolated_typeII_bubble.mif with 4 nm cells
+        geometry = ot.mesh_geometry((-L * 1e-9 / 2, -L * 1e-9 / 2, -100e-9),
+                                    (L * 1e-9 / 2, L * 1e-9 / 2, 100e-9),
+                                    (4e-9, 4e-9, 4e-9))
+        INIT_OMF_FILE = 'init_typeII_bubble_L{}nm_t200nm.omf'.format(L)
+        if INIT_OMF:
+            ist.write_initial_state(INIT_OMF_FILE,
+                                    ist.type2bubble(geometry, R=80e-9),
+                                    geometry)
+
+        field_jobs = []
+        # for Bz in np.arange(0.05, 0.26, 0.01):
+        for Bz in np.arange(40, 331, 10):
+
+            field_jobs.append(osw.SweepJob(
+                'oommf_isolated_typeII_bubble.mif',
+                {'Lx': '{}e-9'.format(int(L)),
+                 'Ly': '{}e-9'.format(int(L)),
+                 'Lz': '200e-9',
+                 'Bz': '{}e-3'.format(int(Bz)),
+                 'BASENAME': '{}/typeII_bubble_Bz{:03d}mT_field-sweep'.format(
+                     SAVE_FOLDER, int(Bz))
+                 }))
+            if INIT_OMF:
+                field_jobs[-1].parameters['OMFFILE'] = INIT_OMF_FILE
+
+        if CONTINUATION:
+            field_jobs = [osw.field_continuation(field_jobs, key='Bz',
+                                                 descending=DESCENDING)]
+        if COARSE_FACTORS:
+            field_jobs = [osw.coarse_to_fine(chain, geometry, COARSE_FACTORS)
+                          for chain in field_jobs]
+        jobs += field_jobs
+
+    if SUPERVISE:
+        records = osu.run_supervised(jobs, total_cores=CORES, budget=BUDGET)
+    else:
+        records = osw.run_sweep(jobs, total_cores=CORES)
+    osw.iteration_savings(records)
+    # Failed runs and runs much slower than their neighbours in the sweep
+    osw.performance_report(records, keys=['Lx', 'Bz'],
+                           output='performance_report.json')